@@ -0,0 +1,123 @@
+'''
+asyncio variant of sEdge
+
+async_sEdge shares discovery, read planning and decoding with sEdge but performs its
+Modbus/TCP transactions with mbtcp.async_client, so that many devices can be polled
+concurrently from one event loop. Points are located and read with sEdge.point as usual.
+
+    async def main() :
+        devices = await connect_hosts([('192.168.12.186', 1502), ('192.168.12.187', 1502)])
+        soc = point(devices[0], "Export", "DERStorageCapacity", "SoC")
+        await poll_hosts(devices)
+        print(soc.read_point())
+    asyncio.run(main())
+'''
+import asyncio
+import logging
+
+from sEdge import sEdge, READ_GAP, REQUEST_COST, retire_headers
+import mbtcp
+
+log = logging.getLogger(__name__)
+
+    # drive a discovery generator (see sEdge.run_reads) with an asyncio client
+async def run_reads(client, steps) :
+    try :
+        request = next(steps)
+        while True :
+            request = steps.send(await client.read_holding_registers(*request))
+    except StopIteration as e :
+        return e.value
+
+class async_sEdge(sEdge) :
+        # no I/O is done here - use connect() (or await open()) to discover the models
+    def __init__(self, host, port, read_gap=READ_GAP, bulk_discovery=True, discovery_cache=None, timeout=5.0, base=40000,
+                 request_cost=REQUEST_COST):
+        self.host = host
+        self.port = port
+        self.base = base
+        self.read_gap = read_gap
+        self.request_cost = request_cost
+        self.bulk_discovery = bulk_discovery
+        self.discovery_cache = discovery_cache
+        self.inverter = mbtcp.async_client(host, port, timeout=timeout)
+        self.headers = None
+
+    @classmethod
+    async def connect(cls, host, port, **kwargs) :
+        system = cls(host, port, **kwargs)
+        await system.open()
+        return system
+
+    async def open(self) :
+        retire_headers(self.headers)
+        self.headers = None
+        if self.discovery_cache :
+            entry = self.cached_discovery()
+            if entry is not None :
+                self.headers = self.restore_discovery(entry, await self.read_fingerprint(self.base))
+        if self.headers is None :
+            await self.refresh_discovery()
+
+    def close(self) :
+        self.inverter.close()
+
+    async def discover(self, reg_addr=40000) :
+        return await run_reads(self.inverter, self.walk_headers(reg_addr))
+
+    async def refresh_discovery(self) :
+        headers = await self.discover(self.base)
+        retire_headers(self.headers)
+        self.headers = headers
+        if self.discovery_cache :
+            self.save_discovery()
+
+    async def read_fingerprint(self, reg_addr=40000) :
+        return await run_reads(self.inverter, self.fingerprint_reads(reg_addr))
+
+    async def load_discovery(self) :
+        entry = self.cached_discovery()
+        if entry is None :
+            return None
+        return self.restore_discovery(entry, await self.read_fingerprint(self.base))
+
+    async def refresh_readings(self) :
+        blocks = []
+        for (addr, count) in self.plan_refresh() :
+            blocks.append((addr, count, await self.inverter.read_holding_registers(addr, count)))
+        self.store_readings(blocks)
+
+    # connect to many (host, port) devices concurrently; devices that fail discovery are returned as None
+async def connect_hosts(hosts, concurrency=16, **kwargs) :
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def connect(host, port) :
+        async with semaphore :
+            try :
+                return await async_sEdge.connect(host, port, **kwargs)
+            except RuntimeError :
+                log.error(f"Unable to discover models of {host}:{port}")
+                return None
+
+    return await asyncio.gather(*(connect(host, port) for (host, port) in hosts))
+
+    # refresh the readings of many devices concurrently, at most concurrency at a time and each
+    # within timeout seconds; returns {(host, port): True if refreshed}
+async def poll_hosts(devices, timeout=1.0, concurrency=16) :
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def poll(system) :
+        async with semaphore :
+            try :
+                await asyncio.wait_for(system.refresh_readings(), timeout)
+            except asyncio.TimeoutError :
+                log.warning(f"Polling {system.host}:{system.port} timed out")
+                for h in system.headers :
+                    if h.reference_count > 0 :
+                        h.values = None
+                return False
+        return all(h.values is not None for h in system.headers if h.reference_count > 0)
+
+    devices = [d for d in devices if d is not None]
+    results = await asyncio.gather(*(poll(d) for d in devices))
+    return {(d.host, d.port): ok for (d, ok) in zip(devices, results)}
@@ -1,8 +1,8 @@
-from sEdge import sEdge, point
+from sEdge import sEdge, point, DISCOVERY_CACHE
 
 #system = sEdge('solaredgeinv.local', 1502)
 #system = sEdge('192.168.1.67', 1502)
-system = sEdge('192.168.12.186', 1502)
+system = sEdge('192.168.12.186', 1502, discovery_cache=DISCOVERY_CACHE)
 ei_battery          = point(system, "Export", "DERStorageCapacity", "SoC")
 
 system.refresh_readings()
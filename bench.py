@@ -0,0 +1,178 @@
+'''
+Benchmarks of the polling hot paths
+
+Measures, for synthetic installations of 1 to 50 devices with and without meters and
+batteries:
+  - discovery: time, requests and bytes for sEdge construction
+  - refresh: time, requests and bytes of refresh_readings for a set of located points
+  - decode: extract operations per second, by point type
+Discovery and refresh are measured against the Modbus/TCP simulator (with its latency
+setting) and against in-memory register arrays, which isolates the Python overhead.
+
+Results are written as json so that runs can be compared over time:
+    python bench.py --output bench.json [--latency 0.005] [--quick]
+'''
+import logging
+import sys
+import json
+import platform
+import random
+from time import time, perf_counter
+
+from sEdge import sEdge, point, raw_decoders
+import simulator
+
+log = logging.getLogger(__name__)
+
+    # installations: name -> models of each device
+installations = {
+    'inverter':               [101],
+    'inverter+meter':         [101, 203],
+    'inverter+battery+meter': [101, 802, 713, 203],
+}
+device_counts = [1, 10, 50]
+
+    # Modbus client reading from an in-memory register map, counting requests and register bytes
+class memory_client :
+    def __init__(self, registers, max_read=simulator.MAX_READ) :
+        self.registers = registers
+        self.max_read = max_read
+        self.requests = 0
+        self.bytes = 0
+
+    def read_holding_registers(self, addr, count) :
+        self.requests += 1
+        self.bytes += 12 + 9                    # request frame and reply (or exception) header
+        if count > self.max_read :
+            return None
+        data = [self.registers.get(a) for a in range(addr, addr + count)]
+        if None in data :
+            return None
+        self.bytes += 2*count
+        return data
+
+    # the points read in the refresh benchmark: a handful of measurements from every model
+def bench_points(system, per_model=5) :
+    points = []
+    for h in system.headers :
+        if h.ID == 1 :
+            device = h.Md
+            continue
+        group = sEdge.models[h.ID]['group']
+        names = [p['name'] for p in group['points'] if p['type'] in ('int16', 'uint16', 'acc32', 'uint32')]
+        for name in names[:per_model] :
+            points.append(point(system, device, group['name'], name))
+    return points
+
+def timed(function, repeat) :
+    start = perf_counter()
+    for i in range(repeat) :
+        result = function()
+    return ((perf_counter() - start) / repeat, result)
+
+def bench_memory(registers, repeat) :
+    client = memory_client(registers)
+    (elapsed, system) = timed(lambda : sEdge('memory', 0, client=client), repeat)
+    discovery = {'seconds': elapsed, 'requests': client.requests // repeat, 'bytes': client.bytes // repeat}
+
+    points = bench_points(system)
+    client.requests = client.bytes = 0
+    (elapsed, result) = timed(system.refresh_readings, repeat)
+    refresh = {'seconds': elapsed, 'points': len(points),
+               'requests': client.requests // repeat, 'bytes': client.bytes // repeat}
+    return (system, discovery, refresh)
+
+def bench_network(registers, latency, repeat, pipeline) :
+    sim = simulator.simulator(registers, latency=latency, change_interval=0)
+    port = sim.start_thread()
+    try :
+        (elapsed, system) = timed(lambda : sEdge('127.0.0.1', port, pipeline=pipeline), repeat)
+        discovery = {'seconds': elapsed, 'requests': sim.stats['requests'] // repeat,
+                     'bytes': (sim.stats['bytes_in'] + sim.stats['bytes_out']) // repeat}
+
+        points = bench_points(system)
+        sim.reset_stats()
+        (elapsed, result) = timed(system.refresh_readings, repeat)
+        refresh = {'seconds': elapsed, 'points': len(points), 'requests': sim.stats['requests'] // repeat,
+                   'bytes': (sim.stats['bytes_in'] + sim.stats['bytes_out']) // repeat}
+    finally :
+        sim.stop_thread()
+    return (discovery, refresh)
+
+    # decode operations per second for each point type, over all points of the system
+def bench_decode(system, duration) :
+    by_type = {}
+    for h in system.headers :
+        if h.ID == 1 :
+            device = h.Md
+            continue
+        system.reference_model(h)
+        group = sEdge.models[h.ID]['group']
+        for p in group['points'] :
+            if p['type'] in raw_decoders :
+                by_type.setdefault(p['type'], []).append(point(system, device, group['name'], p['name']))
+    system.refresh_readings()
+
+    results = {}
+    for (p_type, points) in sorted(by_type.items()) :
+        decoders = [(p.decode, p.header) for p in points]
+        count = 0
+        start = perf_counter()
+        while perf_counter() - start < duration :
+            for (decode, h) in decoders :
+                decode(h.values)
+            count += len(decoders)
+        results[p_type] = count / (perf_counter() - start)
+    return results
+
+def run(latency=0.005, repeat=5, decode_duration=0.5, quick=False, pipeline=0) :
+    random.seed(1)
+    results = {
+        'time': time(),
+        'python': platform.python_version(),
+        'latency': latency,
+        'pipeline': pipeline,
+        'installations': [],
+    }
+    counts = device_counts[:2] if quick else device_counts
+    for (name, models) in installations.items() :
+        for count in counts :
+            devices = [(f'DEV{n:03}', name, models) for n in range(count)]
+            (registers, live) = simulator.build_registers(devices)
+            log.info(f'{name} x {count}')
+            (system, discovery, refresh) = bench_memory(registers, repeat)
+            entry = {
+                'installation': name, 'devices': count, 'registers': len(registers),
+                'memory': {'discovery': discovery, 'refresh': refresh},
+            }
+            (discovery, refresh) = bench_network(registers, latency, 1 if quick else repeat, pipeline)
+            entry['network'] = {'discovery': discovery, 'refresh': refresh}
+            if count == counts[0] :
+                entry['decode_ops'] = bench_decode(system, decode_duration)
+            results['installations'].append(entry)
+    return results
+
+if __name__ == '__main__' :
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="benchmark discovery, refresh and decode")
+    parser.add_argument("--output", help="json file to write (default stdout)")
+    parser.add_argument("--latency", help="simulated Modbus/TCP latency in seconds",
+        type=float, default=0.005)
+    parser.add_argument("--repeat", help="repetitions of each timed operation",
+        type=int, default=5)
+    parser.add_argument("--pipeline", help="requests in flight (0 for the pyModbusTCP client)",
+        type=int, default=0)
+    parser.add_argument("--quick", help="fewer installations and repetitions",
+        action="store_true")
+    args = parser.parse_args()
+
+    results = run(args.latency, args.repeat, quick=args.quick, pipeline=args.pipeline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    else:
+        json.dump(results, sys.stdout, indent=1)
+        print()
@@ -0,0 +1,322 @@
+'''
+Raw register capture and replay
+
+A capture_writer attached to a system records every refresh as the raw register blocks
+read from the device, so that the history can be decoded again later (after fixing a
+decoder, with other points) or replayed to test consumers without the inverter:
+
+    writer = capture_writer('site.cap')
+    writer.record(system)               # every system.refresh_readings() is now appended
+    ...
+    system = sEdge('replay', 0, client=replay_client('site.cap'))
+    soc = point(system, "Export", "DERStorageCapacity", "SoC")
+    while True :
+        system.refresh_readings()       # steps through the captured refreshes
+        if system.inverter.ended :
+            break
+        print(system.inverter.time, soc.read_point())
+
+File format: the line b'MBCAP1\\n' followed by records of
+    uint8   kind: 1 discovery, 2 readings
+    uint16  stream: a host within this file
+    uint32  length of the payload, zlib compressed:
+        discovery:  json {"host", "time", "headers": [{"ID", "offset", "length", "values"}]}
+                    (values of the common models only); starts or restarts the stream
+        readings:   float64 time, uint16 number of blocks, then for each block
+                    uint16 header ID, uint16 offset within the header, uint16 address, uint16 count,
+                    uint8 flags (1: delta, 2: failed read) and, unless failed, count uint16 values;
+                    delta values are the difference (mod 2**16) from the previous block at the
+                    same address and count of the stream
+All integers are big-endian. Records are appended and flushed one refresh at a time; a
+truncated last record is ignored when reading.
+
+    python capture.py record <file> [--ip_address <address>] [--interval <seconds>] [registers...]
+    python capture.py decode <file> <registers...>
+'''
+import logging
+import sys
+import json
+import struct
+import bisect
+import threading
+import zlib
+from array import array
+from time import time, sleep
+
+from sEdge import sEdge, point, wildcard, DISCOVERY_CACHE
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'MBCAP1\n'
+DISCOVERY = 1
+READINGS = 2
+DELTA = 1
+FAILED = 2
+
+RECORD = struct.Struct('>BHI')
+FRAME = struct.Struct('>dH')
+BLOCK = struct.Struct('>HHHHB')
+
+    # records the refreshes of any number of systems to one capture file
+class capture_writer :
+    def __init__(self, path, level=6) :
+        self.path = path
+        self.level = level
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0 :
+            self.file.write(MAGIC)
+        self.streams = {}           # host -> (stream, headers recorded, {(addr, count): values})
+        self.systems = []           # systems being recorded
+        self.lock = threading.Lock()
+
+        # record the refreshes of system
+    def record(self, system) :
+        system.capture = self
+        with self.lock :
+            if system not in self.systems :
+                self.systems.append(system)
+
+        # stop recording the refreshes of system
+    def stop(self, system) :
+        with self.lock :
+            if system.capture is self :
+                system.capture = None
+            if system in self.systems :
+                self.systems.remove(system)
+
+        # stop recording all systems and close the file
+    def close(self) :
+        with self.lock :
+            for system in self.systems :
+                if system.capture is self :
+                    system.capture = None
+            self.systems = []
+            self.file.close()
+
+    def append(self, kind, stream, payload) :
+        data = zlib.compress(payload, self.level)
+        self.file.write(RECORD.pack(kind, stream, len(data)) + data)
+
+        # called by sEdge.store_readings with the (address, count, data) blocks of a refresh
+    def write(self, system, blocks) :
+        host = f'{system.host}:{system.port}'
+        with self.lock :
+            if self.file.closed :
+                return      # closed by another thread during this refresh
+            entry = self.streams.get(host)
+            if entry is None or entry[1] is not system.headers :
+                    # new host or new discovery: describe the headers and restart delta encoding
+                stream = entry[0] if entry is not None else len(self.streams)
+                entry = self.streams[host] = (stream, system.headers, {})
+                self.append(DISCOVERY, stream, json.dumps({
+                    'host': host, 'time': time(),
+                    'headers': [{'ID': h.ID, 'offset': h.offset, 'length': h.length,
+                                 'values': list(h.values) if h.ID == 1 and h.values is not None else None}
+                                for h in system.headers],
+                }).encode())
+            (stream, headers, previous) = entry
+
+            offsets = [h.offset for h in headers]
+            parts = [FRAME.pack(time(), len(blocks))]
+            for (addr, count, data) in blocks :
+                i = bisect.bisect_right(offsets, addr) - 1
+                (ID, offset) = (headers[i].ID, addr - headers[i].offset) if i >= 0 else (0, addr)
+                if data is None :
+                    parts.append(BLOCK.pack(ID, offset, addr, count, FAILED))
+                    continue
+                last = previous.get((addr, count))
+                if last is None :
+                    parts.append(BLOCK.pack(ID, offset, addr, count, 0))
+                    parts.append(array_bytes(data))
+                else :
+                    parts.append(BLOCK.pack(ID, offset, addr, count, DELTA))
+                    parts.append(array_bytes([(v - p) & 0xFFFF for (v, p) in zip(data, last)]))
+                previous[(addr, count)] = list(data)
+            self.append(READINGS, stream, b''.join(parts))
+            self.file.flush()
+
+def array_bytes(values) :
+    a = array('H', values)
+    if sys.byteorder == 'little' :
+        a.byteswap()
+    return a.tobytes()
+
+def bytes_array(data) :
+    a = array('H', data)
+    if sys.byteorder == 'little' :
+        a.byteswap()
+    return a
+
+    # frames of a capture file:
+    #   (DISCOVERY, host, time, headers)
+    #   (READINGS, host, time, [(header ID, offset, address, count, values or None)])
+def read_capture(path) :
+    with open(path, 'rb') as f :
+        if f.read(len(MAGIC)) != MAGIC :
+            raise ValueError(f'{path} is not a register capture')
+        hosts = {}
+        previous = {}
+        while True :
+            head = f.read(RECORD.size)
+            if len(head) < RECORD.size :
+                return
+            (kind, stream, length) = RECORD.unpack(head)
+            data = f.read(length)
+            if len(data) < length :
+                log.warning(f"Truncated record at the end of {path}")
+                return
+            payload = zlib.decompress(data)
+
+            if kind == DISCOVERY :
+                content = json.loads(payload)
+                hosts[stream] = content['host']
+                previous[stream] = {}
+                yield (DISCOVERY, content['host'], content['time'], content['headers'])
+            elif kind == READINGS :
+                last = previous[stream]
+                (t, count) = FRAME.unpack_from(payload)
+                position = FRAME.size
+                blocks = []
+                for i in range(count) :
+                    (ID, offset, addr, n, flags) = BLOCK.unpack_from(payload, position)
+                    position += BLOCK.size
+                    values = None
+                    if not flags & FAILED :
+                        values = bytes_array(payload[position:position + 2*n])
+                        position += 2*n
+                        if flags & DELTA :
+                            values = array('H', [(v + p) & 0xFFFF for (v, p) in zip(values, last[(addr, n)])])
+                        last[(addr, n)] = values
+                    blocks.append((ID, offset, addr, n, values))
+                yield (READINGS, hosts[stream], t, blocks)
+
+    # Modbus client serving the registers of one host of a capture. Discovery reads are answered
+    # from the captured headers; each read_many() (one sEdge.refresh_readings) first advances to the
+    # next captured refresh. A read fails (None) if it touches a register that was never captured or
+    # whose block failed in the current refresh, so replay never makes up values. At the end of the
+    # capture ended is set and the registers of the last refresh are served again.
+class replay_client :
+    def __init__(self, path, host=None) :
+        self.path = path
+        self.host = host
+        self.frames = read_capture(path)
+        self.time = None
+        self.ended = False
+        self.registers = array('H', bytes(2 * 65536))
+        self.valid = bytearray(65536)       # 1 for registers holding captured values
+        for frame in self.frames :
+            if frame[0] == DISCOVERY and (host is None or frame[1] == host) :
+                self.host = frame[1]
+                self.discovered(frame)
+                break
+        else :
+            raise ValueError(f'No discovery of {host or "any host"} in {path}')
+
+        # lay out the SunS marker, model headers and common models of a discovery
+    def discovered(self, frame) :
+        (kind, host, t, headers) = frame
+        self.time = t
+        self.valid = bytearray(65536)
+        start = headers[0]['offset'] - 2
+        self.store(start, array('H', [0x5375, 0x6e53]))        # "SunS"
+        for h in headers :
+            self.store(h['offset'], array('H', [h['ID'], h['length'] - 2]))
+            if h['values'] is not None :
+                self.store(h['offset'], array('H', h['values']))
+        end = headers[-1]['offset'] + headers[-1]['length']
+        self.store(end, array('H', [0xFFFF, 0]))
+
+    def store(self, addr, values) :
+        self.registers[addr:addr + len(values)] = values
+        self.valid[addr:addr + len(values)] = b'\x01' * len(values)
+
+        # move to the next captured refresh of the host; False at the end of the capture
+    def advance(self) :
+        for frame in self.frames :
+            if frame[1] != self.host :
+                continue
+            if frame[0] == DISCOVERY :
+                self.discovered(frame)
+                continue
+            self.time = frame[2]
+            for (ID, offset, addr, count, values) in frame[3] :
+                if values is not None :
+                    self.store(addr, values)
+                else :
+                    self.valid[addr:addr + count] = bytes(count)
+            return True
+        self.ended = True
+        return False
+
+    def close(self) :
+        self.frames.close()
+
+    def read_holding_registers(self, addr, count) :
+        if addr + count > len(self.valid) or 0 in self.valid[addr:addr + count] :
+            return None
+        return self.registers[addr:addr + count].tolist()
+
+    def read_many(self, reads) :
+        self.advance()
+        return [self.read_holding_registers(addr, count) for (addr, count) in reads]
+
+def locate(system, registers) :
+    points = {}
+    for register in registers :
+        for name in system.resolve(register) if wildcard(register) else [register] :
+            (device, model, reg) = name.split('.', maxsplit=3)
+            try :
+                points[name] = point(system, device, model, reg)
+            except RuntimeError :
+                print(f'Unknown point {name}')
+    return points
+
+if __name__ == '__main__' :
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="record raw register captures and decode them offline")
+    parser.add_argument("command", choices=['record', 'decode'])
+    parser.add_argument("file", help="capture file")
+    parser.add_argument("registers", help="<system>.<subsystem>.<reg_name>; all models are recorded if none are given",
+        nargs='*')
+    parser.add_argument("--ip_address", help="IP address of the inverter", default='192.168.12.186')
+    parser.add_argument("--port", help="Modbus/TCP port of the inverter", type=int, default=1502)
+    parser.add_argument("--interval", help="seconds between recorded refreshes", type=float, default=5.0)
+    args = parser.parse_args()
+
+    if args.command == 'record' :
+        try:
+            system = sEdge(args.ip_address, args.port, discovery_cache=DISCOVERY_CACHE)
+        except RuntimeError:
+            sys.exit(1)
+        if args.registers :
+            locate(system, args.registers)
+        else :
+            for h in system.headers :
+                if h.ID != 1 :
+                    system.reference_model(h)
+        writer = capture_writer(args.file)
+        writer.record(system)
+        try:
+            while True :
+                system.refresh_readings()
+                sleep(args.interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            writer.close()
+    else :
+        if not args.registers :
+            parser.error('decode needs the registers to decode')
+        client = replay_client(args.file)
+        system = sEdge('replay', 0, client=client)
+        points = locate(system, args.registers)
+        while True :
+            system.refresh_readings()
+            if client.ended :
+                break
+            values = {name: p.read_point() for (name, p) in points.items()}
+            print(json.dumps({'time': client.time, 'values': {name: r[0] if r else None for (name, r) in values.items()}},
+                             default=str))
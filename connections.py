@@ -0,0 +1,198 @@
+'''
+Shared, self-healing Modbus/TCP connections
+
+Every sEdge in a process takes its client from a connection pool, so systems talking to
+the same device (host, port, unit ID) share one persistent socket:
+
+    system = sEdge('192.168.12.186', 1502)                        # connections.pool
+    system = sEdge('192.168.12.186', 1502, pool=connections.connection_pool(retries=2))
+
+A managed client keeps the read_holding_registers() contract of pyModbusTCP (register values,
+or None) and adds:
+    - retries: a read that fails at the connection level (not a Modbus exception reply) is
+      repeated on a fresh connection up to retries times
+    - backoff: after a failed read the device is not contacted again for backoff seconds,
+      doubling with each consecutive failure up to max_backoff; reads in the meantime return
+      None at once
+    - circuit breaker: after failure_threshold consecutive failures the device is considered
+      dead and only probed once every reset_timeout seconds, with a single attempt and no retries
+
+so a device that is off line costs the other devices of a poll nothing but a time comparison.
+Connections are per process; processes share register data through snapshot.py instead.
+'''
+import logging
+import threading
+from time import monotonic
+
+from pyModbusTCP.client import ModbusClient
+import mbtcp
+
+log = logging.getLogger(__name__)
+
+    # a failed read with one of these last_error codes was answered by the device
+ANSWERED = (mbtcp.NO_ERROR, mbtcp.EXCEPTION_ERROR)
+
+def connection_failed(client) :
+    return getattr(client, 'last_error', None) not in ANSWERED
+
+    # one device's connection with its retry, backoff and circuit breaker state; thread safe
+class managed_client :
+    def __init__(self, pool, inverter, name) :
+        self.pool = pool
+        self.inverter = inverter
+        self.name = name
+        self.lock = threading.RLock()
+        self.failures = 0           # consecutive failed reads
+        self.retry_at = 0.0         # no requests before this (monotonic) time
+        self.last_error = mbtcp.NO_ERROR
+            # counters, reported with those of the wrapped client by counters()
+        self.retries = 0            # reads repeated on a new connection
+        self.timeouts = 0           # attempts that timed out, unless the wrapped client counts them
+        self.rejected = 0           # reads refused while backing off or with the circuit open
+
+    @property
+    def circuit_open(self) :
+        return self.failures >= self.pool.failure_threshold
+
+        # read_many is only offered when the wrapped client pipelines, so that callers (sEdge, metrics)
+        # fall back to, and time, individual requests on a serial client
+    def __getattr__(self, name) :
+        if name == 'read_many' :
+            if hasattr(self.inverter, 'read_many') :
+                return self.pipelined_reads
+            raise AttributeError(name)
+        return getattr(self.inverter, name)
+
+    def close(self) :
+        with self.lock :
+            self.inverter.close()
+
+    def read_holding_registers(self, addr, count) :
+        with self.lock :
+            if not self.allowed() :
+                return None
+            return self.read(addr, count)
+
+        # register data (or None) for each (address, count) read, sent as one batch over the pipelined
+        # client; only the reads lost to a connection failure are read again
+    def pipelined_reads(self, reads) :
+        with self.lock :
+            if not self.allowed(len(reads)) :
+                return [None] * len(reads)
+            results = self.inverter.read_many(reads)
+            if not connection_failed(self.inverter) :
+                self.succeeded()
+                return results
+            self.count_failure()
+            if self.circuit_open or self.pool.retries == 0 :
+                self.failed()
+                return results
+            for (i, data) in enumerate(results) :
+                if data is None :
+                    self.retries += 1
+                    results[i] = self.read(*reads[i], retries=self.pool.retries - 1)
+                    if results[i] is None and connection_failed(self.inverter) :
+                        break
+            return results
+
+        # False while the device is backing off or its circuit is open; the reads refused are counted
+    def allowed(self, reads=1) :
+        if monotonic() >= self.retry_at :
+            return True
+        self.rejected += reads
+        return False
+
+    def read(self, addr, count, retries=None) :
+        if retries is None :
+            retries = 0 if self.circuit_open else self.pool.retries
+        for attempt in range(retries + 1) :
+            if attempt :
+                self.retries += 1
+            data = self.inverter.read_holding_registers(addr, count)
+            self.last_error = getattr(self.inverter, 'last_error', mbtcp.NO_ERROR)
+            if data is not None or not connection_failed(self.inverter) :
+                self.succeeded()
+                return data
+            self.count_failure()
+        self.failed()
+        return None
+
+        # attempt bookkeeping: a timed out or otherwise broken connection is closed and reopened
+    def count_failure(self) :
+        self.last_error = getattr(self.inverter, 'last_error', None)
+        if self.last_error == mbtcp.TIMEOUT_ERROR and not hasattr(self.inverter, 'timeouts') :
+            self.timeouts += 1
+        self.inverter.close()
+
+    def succeeded(self) :
+        if self.circuit_open :
+            log.info(f"{self.name} is answering again")
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def failed(self) :
+        pool = self.pool
+        self.failures += 1
+        if self.failures == pool.failure_threshold :
+            log.warning(f"{self.name} is not answering; retrying every {pool.reset_timeout} seconds")
+        if self.circuit_open :
+            delay = pool.reset_timeout
+        else :
+            delay = min(pool.backoff * 2**(self.failures - 1), pool.max_backoff)
+        self.retry_at = monotonic() + delay
+
+        # (retries, timeouts, rejected) including the requests repeated and timed out inside the wrapped
+        # client (mbtcp.pipelined_client); reported by metrics.instrumented_client
+    def counters(self) :
+        inverter = self.inverter
+        return (self.retries + getattr(inverter, 'retries', 0), self.timeouts + getattr(inverter, 'timeouts', 0),
+                self.rejected)
+
+    def status(self) :
+        (retries, timeouts, rejected) = self.counters()
+        return {'failures': self.failures, 'circuit_open': self.circuit_open,
+                'retry_in': max(self.retry_at - monotonic(), 0.0),
+                'retries': retries, 'timeouts': timeouts, 'rejected': rejected}
+
+    # managed clients by (host, port, unit ID)
+class connection_pool :
+    def __init__(self, timeout=5.0, retries=1, backoff=1.0, max_backoff=60.0, failure_threshold=3, reset_timeout=30.0) :
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clients = {}
+        self.lock = threading.Lock()
+
+        # the shared client of a device; pipeline > 1 selects mbtcp.pipelined_client for a new connection.
+        # A device already connected keeps its client, with a warning if it was opened in the other mode.
+    def client(self, host, port=502, unit_id=1, pipeline=0) :
+        key = (host, port, unit_id)
+        with self.lock :
+            client = self.clients.get(key)
+            if client is not None and (pipeline > 1) != hasattr(client.inverter, 'read_many') :
+                mode = 'serial' if pipeline > 1 else 'pipelined'
+                log.warning(f"{client.name} is already connected with {mode} requests; pipeline={pipeline} is ignored")
+            if client is None :
+                if pipeline > 1 :
+                    inverter = mbtcp.pipelined_client(host, port, unit_id=unit_id, timeout=self.timeout, window=pipeline)
+                else :
+                    inverter = ModbusClient(host=host, port=port, unit_id=unit_id, timeout=self.timeout)
+                name = f'{host}:{port}' if unit_id == 1 else f'{host}:{port}/{unit_id}'
+                client = self.clients[key] = managed_client(self, inverter, name)
+            return client
+
+    def status(self) :
+        with self.lock :
+            return {client.name: client.status() for client in self.clients.values()}
+
+    def close(self) :
+        with self.lock :
+            for client in self.clients.values() :
+                client.close()
+            self.clients = {}
+
+    # the pool used by sEdge unless it is given another
+pool = connection_pool()
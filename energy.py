@@ -0,0 +1,283 @@
+'''
+Incremental energy accounting on accumulator points
+
+Turns the readings of acc16/acc32 points (lifetime Wh and VAh counters of the inverter,
+meter and storage models) into energy per minute, hour and day as the polls arrive, so
+dashboards and the historical logger get daily production, consumption and battery
+throughput from memory instead of scanning raw samples:
+
+    ledger = energy_ledger('energy.json')
+    poller(system, groups, sink=ledger.tee(store.sink)).run()
+    ...
+    ledger.totals(86400)                        # {point name: Wh} for today
+    ledger.rollup('Export.ac_meter.TotWhExp', 3600)     # [(hour start, Wh, estimated seconds)]
+
+Each sample costs O(1): the counter delta since the previous sample is added to the current
+bucket of each rollup. Between two samples
+  - a counter that went backwards from the top half of its range to the bottom half wrapped
+    around (acc16 after 65535, acc32 after 4294967295 raw counts) and the wrapped delta is counted
+  - any other decrease, or an increase faster than max_rate units per second, is a reset or a
+    replaced device: nothing is counted and the new value becomes the baseline
+  - a change of scale factor is counted from the scaled values
+  - failed reads and "not implemented" values are skipped; the next good sample spans the gap
+    and its energy is spread over the buckets it covers in proportion to time. Buckets filled
+    across gaps longer than max_gap record those seconds as estimated.
+Buckets are aligned like the storage.py rollups (UTC multiples of the width, shifted by
+utc_offset seconds for local days) and the last keep buckets of each width are held. The
+ledger is saved to its json file every save_interval seconds and restored on start, so the
+counters stay continuous across restarts; the downtime is treated as a gap.
+
+    python poller.py <config> --energy energy.json
+'''
+import logging
+import os
+import json
+import threading
+from collections import deque
+from time import time
+
+from sEdge import sEdge, raw_decoders, SCALE_FACTORS, scale_factor
+
+log = logging.getLogger(__name__)
+
+ACCUMULATORS = ('acc16', 'acc32')
+    # (bucket width in seconds, buckets kept): minutes for a day, hours for a week, days for a year
+ROLLUPS = ((60, 1440), (3600, 168), (86400, 366))
+    # seconds between samples beyond which the energy between them is an estimate
+MAX_GAP = 300.0
+
+    # build (once per model point) a function returning (raw count, scale) of an accumulator point
+    # from a model's register values, or None if the point is not an accumulator
+def compile_counter(model, point_name) :
+    counters = model['group'].setdefault('counters', {})
+    if point_name in counters :
+        return counters[point_name]
+
+    point_index = model['group']['point_index']
+    p = point_index[point_name]
+    counter = None
+    if p['type'] in ACCUMULATORS :
+        raw = raw_decoders[p['type']]
+        offset = p['offset']
+        sf_offset = None
+        if 'sf' in p and p['sf'] in point_index :
+            sf_offset = point_index[p['sf']]['offset']
+        def counter(values) :
+            if sf_offset is None :
+                return (raw(values, offset), 1)
+            sf_data = values[sf_offset]
+            p_sf = SCALE_FACTORS.get(sf_data)
+            if p_sf is None :
+                p_sf = scale_factor(sf_data)
+            return (raw(values, offset), p_sf)
+        counter.modulus = 1 << (16 * p['size'])
+
+    counters[point_name] = counter
+    return counter
+
+    # energy per bucket of one width, oldest first: [start, energy, estimated seconds]
+class rollup :
+    def __init__(self, width, keep, utc_offset=0) :
+        self.width = width
+        self.keep = keep
+        self.utc_offset = utc_offset
+        self.buckets = deque()
+
+    def bucket(self, t) :
+        return (t + self.utc_offset) // self.width * self.width - self.utc_offset
+
+        # spread energy over [t0, t1) in proportion to time; estimated marks a span across a gap
+    def add(self, t0, t1, energy, estimated=False) :
+        start = self.bucket(t0)
+        if t1 <= start + self.width :
+            self.credit(start, energy, t1 - t0 if estimated else 0.0)
+            return
+            # buckets older than the kept ones would be dropped at once
+        start = max(start, self.bucket(t1) - (self.keep - 1) * self.width)
+        span = t1 - t0
+        b = start
+        while b < t1 :
+            overlap = min(b + self.width, t1) - max(b, t0)
+            self.credit(b, energy * overlap / span, overlap if estimated else 0.0)
+            b += self.width
+
+    def credit(self, start, energy, estimated) :
+        buckets = self.buckets
+        if not buckets or start > buckets[-1][0] :
+            buckets.append([start, energy, estimated])
+            while len(buckets) > self.keep :
+                buckets.popleft()
+            return
+        for entry in reversed(buckets) :
+            if entry[0] == start :
+                entry[1] += energy
+                entry[2] += estimated
+                return
+            if entry[0] < start :
+                break
+        log.debug("Dropping energy of expired bucket %s", start)
+
+    def energy(self, start) :
+        for entry in reversed(self.buckets) :
+            if entry[0] == start :
+                return entry[1]
+            if entry[0] < start :
+                break
+        return 0.0
+
+    # one accumulator: the last good sample and its rollups
+class series :
+    def __init__(self, modulus, rollups=ROLLUPS, utc_offset=0, max_gap=MAX_GAP, max_rate=None) :
+        self.modulus = modulus
+        self.max_gap = max_gap
+        self.max_rate = max_rate
+        self.rollups = {width: rollup(width, keep, utc_offset) for (width, keep) in rollups}
+        self.raw = None             # last good sample
+        self.scale = 1
+        self.time = None
+        self.total = 0.0            # energy counted since tracking began
+        self.wraps = 0
+        self.resets = 0
+        self.missed = 0
+
+        # account for a sample at time t; returns the energy counted
+    def add(self, t, raw, scale) :
+        if raw is None :
+            self.missed += 1
+            return 0.0
+        if self.raw is None or t <= self.time :
+            if self.raw is None :
+                self.baseline(t, raw, scale)
+            return 0.0
+
+        if scale != self.scale :
+            energy = raw * scale - self.raw * self.scale
+        else :
+            delta = raw - self.raw
+            half = self.modulus // 2
+            if delta < 0 and self.raw >= half and raw < half :
+                delta += self.modulus
+                self.wraps += 1
+            energy = delta * scale
+        if energy < 0 or (self.max_rate is not None and energy > self.max_rate * (t - self.time)) :
+            log.warning(f"Counter reset from {self.raw * self.scale} to {raw * scale}; restarting the count")
+            self.resets += 1
+            self.baseline(t, raw, scale)
+            return 0.0
+
+        if energy :
+            estimated = t - self.time > self.max_gap
+            for r in self.rollups.values() :
+                r.add(self.time, t, energy, estimated)
+            self.total += energy
+        self.baseline(t, raw, scale)
+        return energy
+
+    def baseline(self, t, raw, scale) :
+        self.raw = raw
+        self.scale = scale
+        self.time = t
+
+    def state(self) :
+        return {'modulus': self.modulus, 'raw': self.raw, 'scale': self.scale, 'time': self.time,
+                'total': self.total, 'wraps': self.wraps, 'resets': self.resets, 'missed': self.missed,
+                'rollups': {str(width): list(r.buckets) for (width, r) in self.rollups.items()}}
+
+    def restore(self, state) :
+        for name in ('raw', 'scale', 'time', 'total', 'wraps', 'resets', 'missed') :
+            setattr(self, name, state[name])
+        for (width, buckets) in state['rollups'].items() :
+            r = self.rollups.get(int(width))
+            if r is not None :
+                r.buckets = deque(buckets[-r.keep:])
+
+    # energy series of the accumulator points seen in poller samples, by point name; thread safe
+class energy_ledger :
+        # path: json file the ledger is restored from and saved to every save_interval seconds
+        # max_rate: largest plausible increase of a counter in units per second (e.g. Wh/s)
+    def __init__(self, path=None, save_interval=300.0, rollups=ROLLUPS, utc_offset=0, max_gap=MAX_GAP, max_rate=None) :
+        self.path = path
+        self.save_interval = save_interval
+        self.options = {'rollups': rollups, 'utc_offset': utc_offset, 'max_gap': max_gap, 'max_rate': max_rate}
+        self.series = {}
+        self.lock = threading.Lock()
+        self.saved = time()
+        if path is not None and os.path.exists(path) :
+            self.load(path)
+
+        # account for a (point name, point) at time timestamp; points that are not accumulators are ignored
+    def observe(self, timestamp, name, p) :
+        counter = compile_counter(sEdge.models[p.header.ID], p.point_name)
+        if counter is None :
+            return
+        values = p.header.values
+        (raw, scale) = counter(values) if values is not None else (None, 1)
+        with self.lock :
+            s = self.series.get(name)
+            if s is None :
+                s = self.series[name] = series(counter.modulus, **self.options)
+            s.add(timestamp, raw, scale)
+
+        # poller sink
+    def sink(self, timestamp, group, samples) :
+        for (name, p, reading) in samples :
+            self.observe(timestamp, name, p)
+        if self.path is not None and timestamp - self.saved >= self.save_interval :
+            self.save(self.path)
+
+        # poller sink accounting for the samples before passing them on to sink
+    def tee(self, sink) :
+        def both(timestamp, group, samples) :
+            self.sink(timestamp, group, samples)
+            sink(timestamp, group, samples)
+        return both
+
+        # [(bucket start, energy, estimated seconds)] of a point for the buckets of width seconds
+    def rollup(self, name, width) :
+        with self.lock :
+            s = self.series.get(name)
+            if s is None or width not in s.rollups :
+                return []
+            return [tuple(entry) for entry in s.rollups[width].buckets]
+
+        # {point name: energy} in the bucket of width seconds containing t (default now)
+    def totals(self, width, t=None) :
+        if t is None :
+            t = time()
+        with self.lock :
+            return {name: s.rollups[width].energy(s.rollups[width].bucket(t))
+                    for (name, s) in self.series.items() if width in s.rollups}
+
+    def status(self) :
+        with self.lock :
+            return {name: {'total': s.total, 'wraps': s.wraps, 'resets': s.resets, 'missed': s.missed}
+                    for (name, s) in self.series.items()}
+
+        # write the ledger atomically (temp file and rename)
+    def save(self, path) :
+        with self.lock :
+            content = {name: s.state() for (name, s) in self.series.items()}
+            self.saved = time()
+        tmp = f'{path}.tmp'
+        try :
+            with open(tmp, 'w') as f :
+                json.dump(content, f)
+            os.replace(tmp, path)
+        except OSError :
+            log.warning(f"Unable to save the energy ledger to {path}")
+
+    def load(self, path) :
+        try :
+            with open(path) as f :
+                content = json.load(f)
+        except (OSError, ValueError) :
+            log.warning(f"Ignoring unreadable energy ledger {path}")
+            return
+        with self.lock :
+            for (name, state) in content.items() :
+                s = self.series[name] = series(state['modulus'], **self.options)
+                s.restore(state)
+
+    def close(self) :
+        if self.path is not None :
+            self.save(self.path)
@@ -0,0 +1,312 @@
+'''
+Multi-process fleet poller
+
+Polls many sites, each an inverter with its poller groups, from several worker processes so
+that discovery, refresh and decoding are not limited to one interpreter. The supervisor
+  - shards the sites over the workers by poll cost: the measured share of a worker's time
+    each site takes, or an estimate from its points and intervals until that is known
+  - restarts workers that exit, with increasing delays if they keep failing
+  - rebalances the shards when the measured costs have drifted, by restarting the workers
+    whose sites change
+  - writes the samples of all workers as one stream
+Workers send their samples in batches over a pipe (every batch_interval seconds), together
+with the time spent polling each site. Each site keeps its discovery results in its own
+file under cache_dir, so a restarted or reassigned worker does not walk the headers again.
+
+The configuration is a json file:
+    {
+        "workers": 4,
+        "groups": {"power": {"interval": 1, "points": ["SE.inverter.W"]}},
+        "sites": [
+            {"host": "192.168.12.186", "port": 1502},
+            {"host": "192.168.13.20", "port": 1502, "groups": {...}}
+        ]
+    }
+with groups as for poller.py; "groups" at the top level applies to sites without their own.
+Samples are written to stdout as json lines {"time", "host", "group", "values"}.
+
+    python fleet.py <config> [--workers <n>]
+'''
+import logging
+import os
+import json
+import multiprocessing
+import threading
+import queue
+from multiprocessing.connection import wait
+from time import monotonic, perf_counter
+
+from sEdge import sEdge, DISCOVERY_CACHE
+from poller import poller
+
+log = logging.getLogger(__name__)
+
+    # default directory of the per-site discovery caches
+CACHE_DIR = os.path.join(os.path.dirname(DISCOVERY_CACHE), 'fleet')
+    # seconds between batches sent by a worker
+BATCH_INTERVAL = 0.5
+    # seconds between attempts to reconnect a site that failed discovery
+RETRY_INTERVAL = 30.0
+    # seconds between checks for finished discoveries while any are running
+DISCOVERY_CHECK = 0.1
+    # seconds between rebalancing checks, and the improvement in the busiest worker's load needed
+REBALANCE_INTERVAL = 300.0
+REBALANCE_GAIN = 0.2
+    # weight of a new load measurement in the moving average
+LOAD_WEIGHT = 0.3
+    # longest delay before restarting a failing worker; a worker running this long is healthy again
+MAX_RESTART_DELAY = 60.0
+
+def site_name(site) :
+    return f"{site['host']}:{site.get('port', 1502)}"
+
+def cache_path(cache_dir, site) :
+    return os.path.join(cache_dir, ''.join(c if c.isalnum() else '_' for c in site_name(site)) + '.json')
+
+    # rough polls per second of a site, used as its cost until one is measured
+def estimated_cost(site) :
+    return sum(len(g['points']) / g['interval'] for g in site['groups'].values() if g.get('interval', 0) > 0) or 1.0
+
+    # partition the sites (name -> cost) into n shards of similar total cost, largest first
+def shard(costs, n) :
+    shards = [[] for i in range(n)]
+    loads = [0.0] * n
+    for name in sorted(costs, key=costs.get, reverse=True) :
+        i = loads.index(min(loads))
+        shards[i].append(name)
+        loads[i] += costs[name]
+    return (shards, loads)
+
+    # worker process: poll the sites, sending ('samples', [(time, host, group, [(name, reading)])], {host: busy seconds})
+    # batches to conn until it receives 'stop'. Sites are discovered in threads of their own, so an
+    # unreachable site does not hold up the polling of the others while its connection times out.
+def worker(sites, conn, cache_dir, batch_interval=BATCH_INTERVAL) :
+    logging.basicConfig(level=logging.INFO)
+    batch = []
+    busy = {site_name(site): 0.0 for site in sites}
+    pollers = {}
+    retry_at = {site_name(site): 0.0 for site in sites}
+    pending = set()
+    discovered = queue.Queue()
+
+    def sink(host) :
+        def add(timestamp, group, samples) :
+            batch.append((timestamp, host, group, [(name, reading) for (name, p, reading) in samples]))
+        return add
+
+    def discover(site) :
+        try :
+            system = sEdge(site['host'], site.get('port', 1502), discovery_cache=cache_path(cache_dir, site))
+        except RuntimeError :
+            system = None
+        discovered.put((site, system))
+
+    next_batch = monotonic() + batch_interval
+    while True :
+            # start discovery of the sites that are not yet polled, and poll those discovered
+        now = monotonic()
+        for site in sites :
+            name = site_name(site)
+            if name in pollers or name in pending or now < retry_at[name] :
+                continue
+            pending.add(name)
+            threading.Thread(target=discover, args=(site,), name=f'discover {name}', daemon=True).start()
+        while not discovered.empty() :
+            (site, system) = discovered.get()
+            name = site_name(site)
+            pending.discard(name)
+            if system is None :
+                log.error(f"Unable to discover {name}; retrying in {RETRY_INTERVAL} seconds")
+                retry_at[name] = monotonic() + RETRY_INTERVAL
+                continue
+            p = pollers[name] = poller(system, site['groups'], sink(name))
+            p.start(monotonic())
+
+        for (name, p) in pollers.items() :
+            start = perf_counter()
+            p.tick(monotonic())
+            busy[name] += perf_counter() - start
+
+        now = monotonic()
+        if now >= next_batch :
+            conn.send(('samples', batch, busy))
+            batch = []
+            busy = dict.fromkeys(busy, 0.0)
+            next_batch = now + batch_interval
+
+        due = min([p.next_due() for p in pollers.values()] + [next_batch] +
+                  [retry_at[n] for n in retry_at if n not in pollers and n not in pending])
+        if pending :
+            due = min(due, now + DISCOVERY_CHECK)
+        if conn.poll(max(due - monotonic(), 0)) :
+            if conn.recv() == 'stop' :
+                if batch :
+                    conn.send(('samples', batch, busy))
+                return
+
+    # default supervisor sink: json lines on stdout
+def print_sink(timestamp, host, group, values) :
+    print(json.dumps({'time': timestamp, 'host': host, 'group': group, 'values': values}, default=str), flush=True)
+
+    # a worker process and its restart bookkeeping
+class worker_slot :
+    def __init__(self, number) :
+        self.number = number
+        self.sites = []
+        self.process = None
+        self.conn = None
+        self.started = 0.0
+        self.failures = 0
+        self.restart_at = 0.0
+
+class fleet :
+        # sites: [{"host", "port", "groups"}]; sink(timestamp, host, group, {point name: (value, units) or None}) receives each sample
+    def __init__(self, sites, workers=None, sink=print_sink, cache_dir=CACHE_DIR, batch_interval=BATCH_INTERVAL) :
+        self.sites = {site_name(site): site for site in sites}
+        self.workers = [worker_slot(i) for i in range(min(workers or os.cpu_count() or 1, len(self.sites)) or 1)]
+        self.sink = sink
+        self.cache_dir = cache_dir
+        self.batch_interval = batch_interval
+        self.costs = {name: None for name in self.sites}        # measured share of a worker's time
+        self.measured_at = {}
+        self.running = False
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # site name -> cost, falling back to estimates (scaled to the measured costs) for unmeasured sites
+    def cost_table(self) :
+        measured = {name: cost for (name, cost) in self.costs.items() if cost is not None}
+        estimates = {name: estimated_cost(self.sites[name]) for name in self.sites}
+        scale = 1.0
+        if measured :
+            scale = sum(measured.values()) / sum(estimates[name] for name in measured)
+        return {name: measured.get(name, estimates[name] * scale) for name in self.sites}
+
+    def assign(self) :
+        (shards, loads) = shard(self.cost_table(), len(self.workers))
+        for (slot, names) in zip(self.workers, shards) :
+            if sorted(names) != sorted(slot.sites) :
+                slot.sites = names
+                if slot.process is not None :
+                    self.stop_worker(slot)
+        return loads
+
+    def start_worker(self, slot) :
+        (parent, child) = multiprocessing.Pipe()
+        slot.process = multiprocessing.Process(target=worker, name=f'fleet-{slot.number}', daemon=True,
+            args=([self.sites[name] for name in slot.sites], child, self.cache_dir, self.batch_interval))
+        slot.process.start()
+        child.close()
+        slot.conn = parent
+        slot.started = monotonic()
+        log.info(f"Worker {slot.number} polling {len(slot.sites)} site(s)")
+
+    def stop_worker(self, slot) :
+        try :
+            slot.conn.send('stop')
+            while slot.conn.poll(5) :
+                self.receive(slot)
+        except (OSError, EOFError) :
+            pass
+        slot.process.join(5)
+        if slot.process.is_alive() :
+            slot.process.terminate()
+            slot.process.join()
+        slot.conn.close()
+        slot.process = None
+        slot.conn = None
+
+    def receive(self, slot) :
+        (kind, batch, busy) = slot.conn.recv()
+        for (timestamp, host, group, samples) in batch :
+            self.sink(timestamp, host, group, dict(samples))
+        now = monotonic()
+        for (name, seconds) in busy.items() :
+            last = self.measured_at.get(name)
+            self.measured_at[name] = now
+            if last is None :
+                continue
+            load = seconds / max(now - last, 1e-3)
+            cost = self.costs[name]
+            self.costs[name] = load if cost is None else cost + LOAD_WEIGHT * (load - cost)
+
+        # a worker that exited is restarted after a delay doubling with each consecutive failure
+    def reap(self, slot) :
+        log.error(f"Worker {slot.number} exited with {slot.process.exitcode}")
+        slot.conn.close()
+        slot.process = None
+        slot.conn = None
+        healthy = monotonic() - slot.started > MAX_RESTART_DELAY
+        slot.failures = 0 if healthy else slot.failures + 1
+        slot.restart_at = monotonic() + min(2 ** slot.failures - 1, MAX_RESTART_DELAY)
+
+        # rebalance if the busiest worker's load would drop enough; only once every site is measured
+    def rebalance(self) :
+        if any(cost is None for cost in self.costs.values()) :
+            return
+        loads = [sum(self.costs[name] for name in slot.sites) for slot in self.workers]
+        (shards, new_loads) = shard(self.costs, len(self.workers))
+        if max(new_loads) < max(loads) * (1 - REBALANCE_GAIN) :
+            log.info(f"Rebalancing: busiest worker load {max(loads):.3f} -> {max(new_loads):.3f}")
+            self.assign()
+
+    def run(self, duration=None) :
+        start = monotonic()
+        self.assign()
+        next_rebalance = start + REBALANCE_INTERVAL
+        self.running = True
+        try :
+            while self.running :
+                now = monotonic()
+                for slot in self.workers :
+                    if slot.process is None and slot.sites and now >= slot.restart_at :
+                        self.start_worker(slot)
+                if duration is not None and now - start >= duration :
+                    break
+                if now >= next_rebalance :
+                    self.rebalance()
+                    next_rebalance = now + REBALANCE_INTERVAL
+
+                active = [slot for slot in self.workers if slot.process is not None]
+                ready = wait([slot.conn for slot in active] + [slot.process.sentinel for slot in active], timeout=1.0)
+                for slot in active :
+                    if slot.conn in ready :
+                        try :
+                            self.receive(slot)
+                            continue
+                        except (EOFError, OSError) :
+                            slot.process.join(5)
+                    if not slot.process.is_alive() :
+                        self.reap(slot)
+        finally :
+            for slot in self.workers :
+                if slot.process is not None :
+                    self.stop_worker(slot)
+
+    def stop(self) :
+        self.running = False
+
+def load_config(path) :
+    with open(path) as f :
+        config = json.load(f)
+    sites = []
+    for site in config['sites'] :
+        site = dict(site)
+        site.setdefault('groups', config.get('groups', {}))
+        sites.append(site)
+    return (config, sites)
+
+if __name__ == '__main__' :
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="poll many sites from several worker processes")
+    parser.add_argument("config", help="json fleet configuration")
+    parser.add_argument("--workers", help="number of worker processes, overriding the configuration", type=int)
+    args = parser.parse_args()
+
+    (config, sites) = load_config(args.config)
+    try:
+        fleet(sites, args.workers or config.get('workers')).run()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,224 @@
+'''
+Modbus/TCP framing for holding register reads
+
+pyModbusTCP provides the blocking client used by sEdge; this module holds the minimal
+framing needed by the clients that pyModbusTCP does not provide (asyncio, pipelined),
+so only function 3 (read holding registers) is supported.
+
+A request is an MBAP header (transaction ID, protocol 0, length, unit ID) followed by the
+PDU: function code, starting address and register count. The reply PDU is the function
+code, a byte count and the big-endian register values, or function|0x80 and an exception code.
+'''
+import asyncio
+import logging
+import socket
+import struct
+
+log = logging.getLogger(__name__)
+
+READ_HOLDING_REGISTERS = 3
+SERVER_DEVICE_BUSY = 6
+
+    # last_error codes, as reported by pyModbusTCP's client
+NO_ERROR = 0
+RECV_ERROR = 4
+TIMEOUT_ERROR = 5
+EXCEPTION_ERROR = 7
+
+MBAP = struct.Struct('>HHHB')           # transaction ID, protocol ID, length, unit ID
+READ_REQUEST = struct.Struct('>HHHBBHH')
+
+    # complete read request frame
+def read_request(tid, unit_id, addr, count) :
+    return READ_REQUEST.pack(tid, 0, 6, unit_id, READ_HOLDING_REGISTERS, addr, count)
+
+    # register values from a read reply PDU, or None for an exception or malformed reply
+def parse_read_reply(pdu, count) :
+    if len(pdu) < 2 or pdu[0] != READ_HOLDING_REGISTERS :
+        if len(pdu) >= 2 and pdu[0] == READ_HOLDING_REGISTERS | 0x80 :
+            log.debug("Modbus exception %d", pdu[1])
+        return None
+    if pdu[1] != 2*count or len(pdu) != 2 + 2*count :
+        return None
+    return list(struct.unpack(f'>{count}H', pdu[2:]))
+
+    # exception code of a reply PDU, or None if the reply is not an exception
+def exception_code(pdu) :
+    if len(pdu) >= 2 and pdu[0] & 0x80 :
+        return pdu[1]
+    return None
+
+    # a pipelining client drops to serial reads after this many consecutive failed batches (or at once
+    # if the device reports busy), and tries the configured window again after REPROBE_BATCHES clean
+    # serial batches, doubling that for every further drop up to MAX_REPROBE_BATCHES
+PIPELINE_FAILURES = 3
+REPROBE_BATCHES = 100
+MAX_REPROBE_BATCHES = 6400
+
+    # blocking client that keeps one persistent connection and sends a batch of reads back to back,
+    # up to window requests in flight, matching the replies by transaction ID. Devices that keep dropping
+    # the connection or stop answering while requests are pipelined, or report busy, are switched to
+    # serial reads for a while.
+class pipelined_client :
+    def __init__(self, host, port=502, unit_id=1, timeout=5.0, window=8) :
+        self.host = host
+        self.port = port
+        self.unit_id = unit_id
+        self.timeout = timeout
+        self.window = window        # current window, 1 while reading serially
+        self.configured_window = window
+        self.sock = None
+        self.buffer = b''
+        self.tid = 0
+        self.retries = 0            # requests repeated after a failed batch
+        self.timeouts = 0           # batches that failed by timing out
+        self.last_error = NO_ERROR  # of the last batch
+        self.failures = 0           # consecutive failed pipelined batches
+        self.clean = 0              # clean serial batches since pipelining was dropped
+        self.drops = 0              # times pipelining was dropped
+        self.reprobe = REPROBE_BATCHES
+
+    def open(self) :
+        self.sock = socket.create_connection((self.host, self.port), self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = b''
+
+    def close(self) :
+        if self.sock is not None :
+            self.sock.close()
+        self.sock = None
+
+    def read_holding_registers(self, addr, count) :
+        return self.read_many([(addr, count)])[0]
+
+        # register data (or None) for each (address, count) read
+    def read_many(self, reads) :
+        window = self.window
+        (results, answered, error) = self.transfer(reads, window)
+        if error is None :
+            if window > 1 :
+                self.failures = 0
+            elif self.configured_window > 1 :
+                self.clean += 1
+                if self.clean >= self.reprobe :
+                    log.info(f"Trying pipelined requests to {self.host}:{self.port} again")
+                    self.window = self.configured_window
+                    self.clean = 0
+            return results
+
+        self.clean = 0
+        if window > 1 :
+            self.failures += 1
+            busy = isinstance(error, ConnectionError) and error.args == ('device busy',)
+            if busy or self.failures >= PIPELINE_FAILURES :
+                log.warning(f"{self.host}:{self.port} does not accept pipelined requests; reading serially")
+                self.window = 1
+                self.failures = 0
+                self.drops += 1
+                self.reprobe = min(REPROBE_BATCHES * 2**(self.drops - 1), MAX_REPROBE_BATCHES)
+                # the reads not answered are repeated one at a time
+            retry = [r for r in range(len(reads)) if r not in answered]
+            self.retries += len(retry)
+            (data, answered, error) = self.transfer([reads[r] for r in retry], 1)
+            for (r, d) in zip(retry, data) :
+                results[r] = d
+        return results
+
+        # send reads with up to window in flight; returns (results, indices answered, OSError or None)
+    def transfer(self, reads, window) :
+        results = [None] * len(reads)
+        answered = set()
+        self.last_error = NO_ERROR
+        try :
+            if self.sock is None :
+                self.open()
+            pending = {}
+            i = 0
+            while i < len(reads) or pending :
+                    # top up the requests in flight
+                frames = []
+                while i < len(reads) and len(pending) < window :
+                    self.tid = (self.tid + 1) & 0xFFFF
+                    pending[self.tid] = i
+                    frames.append(read_request(self.tid, self.unit_id, *reads[i]))
+                    i += 1
+                if frames :
+                    self.sock.sendall(b''.join(frames))
+
+                (tid, pdu) = self.receive()
+                if tid not in pending :
+                    continue    # late reply to an earlier, failed batch
+                r = pending.pop(tid)
+                if window > 1 and exception_code(pdu) == SERVER_DEVICE_BUSY :
+                    raise ConnectionError('device busy')
+                results[r] = parse_read_reply(pdu, reads[r][1])
+                if results[r] is None :
+                    self.last_error = EXCEPTION_ERROR
+                answered.add(r)
+        except OSError as e :
+            log.debug("Reads from %s:%s failed: %r", self.host, self.port, e)
+            self.close()
+            if isinstance(e, socket.timeout) :
+                self.timeouts += 1
+            self.last_error = TIMEOUT_ERROR if isinstance(e, socket.timeout) else RECV_ERROR
+            return (results, answered, e)
+        return (results, answered, None)
+
+    def receive(self) :
+        header = self.receive_exactly(MBAP.size)
+        (tid, protocol, length, unit_id) = MBAP.unpack(header)
+        return (tid, self.receive_exactly(length - 1))
+
+    def receive_exactly(self, size) :
+        while len(self.buffer) < size :
+            data = self.sock.recv(4096)
+            if not data :
+                raise ConnectionError('connection closed')
+            self.buffer += data
+        (data, self.buffer) = (self.buffer[:size], self.buffer[size:])
+        return data
+
+    # asyncio client with the same read_holding_registers() contract as pyModbusTCP: the register
+    # values, or None on any failure. The connection is opened on first use and reopened after a failure.
+class async_client :
+    def __init__(self, host, port=502, unit_id=1, timeout=5.0) :
+        self.host = host
+        self.port = port
+        self.unit_id = unit_id
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.tid = 0
+        self.lock = asyncio.Lock()
+
+    async def open(self) :
+        (self.reader, self.writer) = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout)
+
+    def close(self) :
+        if self.writer is not None :
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+    async def read_holding_registers(self, addr, count) :
+        async with self.lock :
+            try :
+                return await asyncio.wait_for(self.transaction(addr, count), self.timeout)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e :
+                log.debug("Read of %d registers at %d from %s:%s failed: %r", count, addr, self.host, self.port, e)
+                self.close()
+                return None
+
+    async def transaction(self, addr, count) :
+        if self.writer is None :
+            await self.open()
+        self.tid = (self.tid + 1) & 0xFFFF
+        self.writer.write(read_request(self.tid, self.unit_id, addr, count))
+        await self.writer.drain()
+        while True :
+            (tid, protocol, length, unit_id) = MBAP.unpack(await self.reader.readexactly(MBAP.size))
+            pdu = await self.reader.readexactly(length - 1)
+                # discard late replies to earlier, timed out requests
+            if tid == self.tid :
+                return parse_read_reply(pdu, count)
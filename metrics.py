@@ -0,0 +1,237 @@
+'''
+Optional instrumentation of sEdge
+
+A metrics registry collects counters and histograms from the systems it is given to:
+
+    registry = metrics.metrics()
+    system = sEdge('192.168.12.186', 1502, metrics=registry)
+    registry.serve(9108)            # Prometheus text format on http://<host>:9108/metrics
+    registry.stats()                # the same values as a dict
+
+Collected, labelled by device ("host:port"):
+    modbus_request_seconds      histogram of single read request round trips
+    modbus_batch_seconds        histogram of pipelined batches of reads
+    modbus_requests_total       read requests sent
+    modbus_failures_total       read requests that returned no data
+    modbus_timeouts_total       failures reported as timeouts by the client
+    modbus_retries_total        requests repeated by the client (connection pool, pipelined client serial fallback)
+    modbus_rejected_total       requests refused by the connection pool while a device is backing off
+    refresh_seconds             histogram of refresh_readings() calls
+    refresh_registers_total     registers read by refresh_readings()
+    discovery_seconds           histogram of model header walks and discovery cache restores
+    discovery_cache_total       discovery cache lookups, by result (hit, miss, stale)
+    decode_seconds              histogram of point decodes, also labelled by model ID
+    model_decode_seconds        histogram of decode_model() calls, also labelled by model ID
+    point_reads_total           point reads, by result (hit: cached decode reused, miss: decoded)
+
+Systems created without a registry only test for it being None on each instrumented path.
+'''
+import bisect
+import logging
+import threading
+from time import perf_counter
+
+log = logging.getLogger(__name__)
+
+    # histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+DECODE_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 1e-3)
+buckets = {'decode_seconds': DECODE_BUCKETS}
+
+descriptions = {
+    'modbus_request_seconds': 'Round trip time of single Modbus read requests',
+    'modbus_batch_seconds': 'Time to complete a pipelined batch of Modbus read requests',
+    'modbus_requests_total': 'Modbus read requests sent',
+    'modbus_failures_total': 'Modbus read requests that returned no data',
+    'modbus_timeouts_total': 'Modbus read requests that timed out',
+    'modbus_retries_total': 'Modbus read requests repeated by the client',
+    'modbus_rejected_total': 'Modbus read requests refused while the device is backing off or its circuit is open',
+    'refresh_seconds': 'Time taken by refresh_readings',
+    'refresh_registers_total': 'Registers read by refresh_readings',
+    'discovery_seconds': 'Time taken to walk the model headers or restore them from the cache',
+    'discovery_cache_total': 'Discovery cache lookups by result',
+    'decode_seconds': 'Time taken to decode a point',
+    'model_decode_seconds': 'Time taken to decode a complete model block with decode_model',
+    'point_reads_total': 'Point reads by result: hit reused the cached decode, miss decoded the registers',
+}
+
+    # cumulative histogram: counts[i] is the number of observations <= buckets[i]; the last count is +Inf
+class histogram :
+    def __init__(self, buckets=LATENCY_BUCKETS) :
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value) :
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) :
+        total = 0
+        for (bound, count) in zip(self.buckets + (float('inf'),), self.counts) :
+            total += count
+            yield (bound, total)
+
+    def stats(self) :
+        return {'count': self.count, 'sum': self.sum, 'mean': self.sum / self.count if self.count else None,
+                'buckets': {str(bound): total for (bound, total) in self.cumulative()}}
+
+    # values are keyed by (name, labels) where labels is a sorted tuple of (label, value) pairs
+class metrics :
+    def __init__(self) :
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def count(self, name, amount=1, **labels) :
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock :
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels) :
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock :
+            h = self.histograms.get(key)
+            if h is None :
+                h = self.histograms[key] = histogram(buckets.get(name, LATENCY_BUCKETS))
+            h.observe(value)
+
+        # wrap a Modbus client so that its requests are timed and counted
+    def client(self, inverter, device) :
+        return instrumented_client(inverter, self, device)
+
+        # {name: [{'labels': {...}, 'value': n} or {'labels': {...}, 'count': ..., 'sum': ..., ...}]}
+    def stats(self) :
+        result = {}
+        with self.lock :
+            for ((name, labels), value) in sorted(self.counters.items()) :
+                result.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+            for ((name, labels), h) in sorted(self.histograms.items(), key=lambda item: item[0]) :
+                result.setdefault(name, []).append({'labels': dict(labels), **h.stats()})
+        return result
+
+        # Prometheus text exposition format
+    def prometheus(self) :
+        lines = []
+        with self.lock :
+            counters = sorted(self.counters.items())
+            histograms = sorted(((key, (h.buckets, list(h.counts), h.sum, h.count)) for (key, h) in self.histograms.items()),
+                                key=lambda item: item[0])
+        name = None
+        for ((n, labels), value) in counters :
+            if n != name :
+                name = n
+                lines.append(f'# HELP {name} {descriptions.get(name, name)}')
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{label_text(labels)} {value}')
+        for ((n, labels), (buckets, counts, total, count)) in histograms :
+            if n != name :
+                name = n
+                lines.append(f'# HELP {name} {descriptions.get(name, name)}')
+                lines.append(f'# TYPE {name} histogram')
+            cumulative = 0
+            for (bound, c) in zip(buckets + (float('inf'),), counts) :
+                cumulative += c
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{label_text(labels + (("le", le),))} {cumulative}')
+            lines.append(f'{name}_sum{label_text(labels)} {total!r}')
+            lines.append(f'{name}_count{label_text(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+        # serve the Prometheus text on http://host:port/metrics from a daemon thread; returns the port
+    def serve(self, port=9108, host='') :
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        registry = self
+
+        class handler(BaseHTTPRequestHandler) :
+            def do_GET(self) :
+                if self.path.split('?')[0] not in ('/', '/metrics') :
+                    self.send_error(404)
+                    return
+                body = registry.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args) :
+                log.debug(format, *args)
+
+        self.server = ThreadingHTTPServer((host, port), handler)
+        threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True).start()
+        return self.server.server_address[1]
+
+    def close(self) :
+        if self.server is not None :
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+def label_text(labels) :
+    if not labels :
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for (_, value) in labels)
+    return '{' + ','.join(f'{label}="{value}"' for ((label, _), value) in zip(labels, escaped)) + '}'
+
+    # pyModbusTCP reports timeouts through last_error
+try :
+    from pyModbusTCP.constants import MB_TIMEOUT_ERR
+except ImportError :
+    MB_TIMEOUT_ERR = None
+
+    # Modbus client wrapper timing and counting the read requests of the wrapped client; clients
+    # keeping their own retries, timeouts and rejected counters (connections.managed_client, which
+    # adds those of the pipelined client it wraps, and mbtcp.pipelined_client) have those reported,
+    # otherwise a timeout is recognised from pyModbusTCP's last_error
+class instrumented_client :
+    def __init__(self, inverter, registry, device) :
+        self.inverter = inverter
+        self.registry = registry
+        self.device = device
+
+    def __getattr__(self, name) :
+        return getattr(self.inverter, name)
+
+    def read_holding_registers(self, addr, count) :
+        before = self.counters()
+        start = perf_counter()
+        data = self.inverter.read_holding_registers(addr, count)
+        self.registry.observe('modbus_request_seconds', perf_counter() - start, device=self.device)
+        self.record(1, 0 if data is not None else 1, before)
+        return data
+
+    def read_many(self, reads) :
+        if not hasattr(self.inverter, 'read_many') :
+            return [self.read_holding_registers(addr, count) for (addr, count) in reads]
+        before = self.counters()
+        start = perf_counter()
+        results = self.inverter.read_many(reads)
+        self.registry.observe('modbus_batch_seconds', perf_counter() - start, device=self.device)
+        self.record(len(reads), sum(data is None for data in results), before)
+        return results
+
+    def counters(self) :
+        inverter = self.inverter
+        if hasattr(inverter, 'counters') :
+            return inverter.counters()
+        return (getattr(inverter, 'retries', 0), getattr(inverter, 'timeouts', None), getattr(inverter, 'rejected', 0))
+
+    def record(self, requests, failures, before) :
+        registry = self.registry
+        registry.count('modbus_requests_total', requests, device=self.device)
+        (retries, timeouts, rejected) = self.counters()
+        if retries != before[0] :
+            registry.count('modbus_retries_total', retries - before[0], device=self.device)
+        if rejected != before[2] :
+            registry.count('modbus_rejected_total', rejected - before[2], device=self.device)
+        if timeouts is not None :
+            if timeouts != before[1] :
+                registry.count('modbus_timeouts_total', timeouts - before[1], device=self.device)
+        elif failures and MB_TIMEOUT_ERR is not None and getattr(self.inverter, 'last_error', None) == MB_TIMEOUT_ERR :
+            registry.count('modbus_timeouts_total', failures, device=self.device)
+        if failures :
+            registry.count('modbus_failures_total', failures, device=self.device)
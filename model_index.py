@@ -0,0 +1,135 @@
+'''
+Precompiled index of the SunSpec models
+
+Parsing the SunSpec JSON models and building the point offsets, point index and symbol
+tables dominates the startup of short-lived scripts. The index file holds every model
+already prepared and pickled; a table at the start of the file locates each model so that
+only the models a device actually uses are unpickled.
+
+Build (or rebuild) the index after updating the models submodule:
+    python model_index.py
+'''
+import logging
+import os
+import sys
+import json
+import mmap
+import marshal
+import pickle
+
+log = logging.getLogger(__name__)
+
+cwd = os.path.dirname(__file__)
+    # the models submodule, unless SUNSPEC_MODELS names another copy of the models' json directory
+sunSpecModelPath = os.environ.get('SUNSPEC_MODELS') or os.path.join(cwd,"models",'json')
+MODEL_INDEX = os.path.join(cwd, 'model_index.bin')
+
+    # add relative offset information, a point index and symbol tables to a loaded model
+def prepare_model(model) :
+    point_index = {}
+    offset = 0
+    for p in model['group']['points'] :
+        point_index[p['name']] = p
+        p['offset'] = offset
+            # create symbol table from symbols information, if present
+        if 'symbols' in p :
+            symbol_table = {}
+            for s in p['symbols'] :
+                symbol_table[s['value']] = s['name']
+            p['symbol_table'] = symbol_table
+        offset += p['size']
+    model['group']['point_index'] = point_index
+    return model
+
+def load_json_model(m_type, json_path=sunSpecModelPath) :
+    with open(os.path.join(json_path, f'model_{m_type}.json')) as f :
+        return prepare_model(json.load(f))
+
+    # compile every model_<n>.json file into the index
+    # layout: 4-byte table length, marshalled table {m_type: (offset, length, source mtime)}, pickled models
+def build_index(json_path=sunSpecModelPath, index_path=MODEL_INDEX) :
+    blobs = {}
+    for name in os.listdir(json_path) :
+        if not (name.startswith('model_') and name.endswith('.json')) :
+            continue
+        try :
+            m_type = int(name[len('model_'):-len('.json')])
+        except ValueError :
+            continue
+        source = os.path.join(json_path, name)
+        blobs[m_type] = (pickle.dumps(load_json_model(m_type, json_path), pickle.HIGHEST_PROTOCOL),
+                         os.stat(source).st_mtime_ns)
+
+    table = {}
+    offset = 0
+    for m_type in sorted(blobs) :
+        (blob, mtime) = blobs[m_type]
+        table[m_type] = (offset, len(blob), mtime)
+        offset += len(blob)
+    table_data = marshal.dumps(table)
+
+    temp = f'{index_path}.{os.getpid()}'
+    with open(temp, 'wb') as f :
+        f.write(len(table_data).to_bytes(4, 'little'))
+        f.write(table_data)
+        for m_type in sorted(blobs) :
+            f.write(blobs[m_type][0])
+    os.replace(temp, index_path)
+    return len(table)
+
+    # lazily mapped view of the index file
+class model_index :
+    def __init__(self, index_path=MODEL_INDEX, json_path=sunSpecModelPath) :
+        self.json_path = json_path
+        with open(index_path, 'rb') as f :
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        table_length = int.from_bytes(self.map[:4], 'little')
+        self.table = marshal.loads(self.map[4:4+table_length])
+        self.base = 4 + table_length
+
+    def __contains__(self, m_type) :
+        return m_type in self.table
+
+        # unpickle a model; None if it is not indexed or its JSON source has changed since the build
+    def load(self, m_type) :
+        if m_type not in self.table :
+            return None
+        (offset, length, mtime) = self.table[m_type]
+        try :
+            if os.stat(os.path.join(self.json_path, f'model_{m_type}.json')).st_mtime_ns != mtime :
+                log.info(f"Model {m_type} changed since the index was built")
+                return None
+        except FileNotFoundError :
+            pass    # the index may be deployed without the JSON models
+        start = self.base + offset
+        return pickle.loads(self.map[start:start+length])
+
+    # shared index, opened on first use
+_index = None
+def open_index() :
+    global _index
+    if _index is None :
+        try :
+            _index = model_index()
+        except (OSError, ValueError, EOFError) :
+            _index = False
+    return _index or None
+
+if __name__ == '__main__' :
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="compile the SunSpec JSON models into a model index")
+    parser.add_argument("--models", help="directory holding the SunSpec JSON models",
+        default=sunSpecModelPath)
+    parser.add_argument("--output", help="index file to write",
+        default=MODEL_INDEX)
+    args = parser.parse_args()
+
+    try:
+        count = build_index(args.models, args.output)
+    except OSError as e:
+        log.error(f'Unable to build model index: {e}')
+        sys.exit(1)
+    print(f'{count} models written to {args.output}')
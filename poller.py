@@ -0,0 +1,199 @@
+'''
+Periodic poller
+
+Reads groups of points on fixed schedules, e.g. power every second, energy counters every
+minute and nameplate data once. Groups that are due in the same tick share one
+refresh_readings() so their registers are read in a single read plan.
+
+Ticks are kept on a fixed grid anchored at start-up, so time spent polling does not
+accumulate as drift. A group that overruns its interval skips the ticks it missed rather
+than queueing them.
+
+The configuration is a json file:
+    {
+        "host": "192.168.12.186",
+        "port": 1502,
+        "groups": {
+            "power":     {"interval": 1,  "points": ["SE.inverter.W", "Export.ac_meter.W", "Export.DERStorageCapacity.SoC"]},
+            "energy":    {"interval": 60, "points": ["Export.ac_meter.TotWhExp", "Export.ac_meter.TotWhImp"]},
+            "nameplate": {"interval": 0,  "points": ["Export.DERStorageCapacity.WHRtg"]}
+        }
+    }
+An interval of 0 reads the group once. A group with "on_change": true only reports the
+points whose values changed, optionally beyond a "deadband" (absolute) or "deadband_pct"
+(percent) given for the group. Points are named <system>.<subsystem>.<reg_name> as
+for the sEdge command line. Samples are written to stdout as json lines, or to a SQLite
+database with --database. --metrics <port> serves request, refresh and decode metrics
+for Prometheus (see metrics.py), and --capture <file> records the raw registers of every
+poll for offline decoding (see capture.py). --energy <file> keeps per minute, hour and day
+energy of the accumulator points polled (see energy.py), saved to that json file.
+'''
+import logging
+import sys
+import json
+import math
+from time import time, monotonic, sleep
+
+from sEdge import sEdge, point, DISCOVERY_CACHE
+
+log = logging.getLogger(__name__)
+
+    # groups due within this many seconds of each other are read together
+TICK_TOLERANCE = 0.01
+
+    # a group of points read on the same schedule
+class schedule :
+    def __init__(self, name, interval, points, on_change=False) :
+        self.name = name
+        self.interval = interval
+        self.points = points        # [(name, point)]
+        self.on_change = on_change
+        self.next_due = 0.0
+        self.overruns = 0
+
+        # move to the next tick on the grid, skipping any ticks that have already passed
+    def advance(self, now) :
+        if self.interval <= 0 :
+            self.next_due = math.inf
+            return
+        self.next_due += self.interval
+        if self.next_due <= now :
+            missed = math.floor((now - self.next_due) / self.interval) + 1
+            self.overruns += missed
+            log.warning(f"Group {self.name} overran, skipping {missed} tick(s)")
+            self.next_due += missed * self.interval
+
+    # resolve a "<system>.<subsystem>.<reg_name>" name to a point
+def make_point(system, name, **kwargs) :
+    (device, model, reg) = name.split('.', maxsplit=2)
+    return point(system, device, model, reg, **kwargs)
+
+    # default sink: json lines on stdout
+def print_sink(timestamp, group, samples) :
+    print(json.dumps({'time': timestamp, 'group': group,
+                      'values': {name: value for (name, p, value) in samples}}, default=str), flush=True)
+
+class poller :
+        # groups is {name: {"interval": seconds, "points": [point names]}}
+        # sink(timestamp, group name, [(point name, point, (value, units) or None)]) receives each sample
+    def __init__(self, system, groups, sink=print_sink) :
+        self.system = system
+        self.sink = sink
+        self.schedules = []
+        for (name, g) in groups.items() :
+            points = []
+            for point_name in g['points'] :
+                try :
+                    points.append((point_name, make_point(system, point_name,
+                        deadband=g.get('deadband'), deadband_pct=g.get('deadband_pct'))))
+                except (RuntimeError, ValueError) :
+                    log.error(f"Unknown point {point_name} in group {name}")
+            self.schedules.append(schedule(name, g.get('interval', 0), points, g.get('on_change', False)))
+        self.running = False
+
+        # poll the groups that are due at monotonic time now
+    def tick(self, now) :
+        due = [s for s in self.schedules if s.next_due <= now + TICK_TOLERANCE]
+        if not due :
+            return
+        points = {id(p): p for s in due for (name, p) in s.points}
+        self.system.refresh_readings(list(points.values()))
+        timestamp = time()
+        for s in due :
+            if s.on_change :
+                samples = [(name, p, reading) for (name, p) in s.points for reading in [p.read_changed()] if reading is not None]
+                if samples :
+                    self.sink(timestamp, s.name, samples)
+            else :
+                self.sink(timestamp, s.name, [(name, p, p.read_point()) for (name, p) in s.points])
+
+        finished = monotonic()
+        for s in due :
+            s.advance(finished)
+
+        # make every group due at monotonic time now, for callers driving tick() themselves
+    def start(self, now) :
+        for s in self.schedules :
+            s.next_due = now
+
+        # monotonic time the next group is due, inf if only run-once groups remain
+    def next_due(self) :
+        return min((s.next_due for s in self.schedules), default=math.inf)
+
+    def run(self, duration=None) :
+        start = monotonic()
+        self.start(start)
+        self.running = True
+        while self.running :
+            self.tick(monotonic())
+            next_due = self.next_due()
+            if next_due == math.inf :
+                break       # only run-once groups
+            if duration is not None and next_due - start >= duration :
+                break
+            delay = next_due - monotonic()
+            if delay > 0 :
+                sleep(delay)
+
+    def stop(self) :
+        self.running = False
+
+if __name__ == '__main__' :
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="poll groups of points on fixed schedules")
+    parser.add_argument("config", help="json poller configuration")
+    parser.add_argument("--ip_address", help="IP address of the inverter, overriding the configuration")
+    parser.add_argument("--database", help="store samples in this SQLite database instead of printing them")
+    parser.add_argument("--metrics", help="serve Prometheus metrics of the polling on this port", type=int)
+    parser.add_argument("--capture", help="also append the raw registers of every poll to this capture file")
+    parser.add_argument("--energy", help="account the energy of the polled accumulator points in this json file")
+    args = parser.parse_args()
+
+    with open(args.config) as f :
+        config = json.load(f)
+    host = args.ip_address or config.get('host', '192.168.12.186')
+
+    registry = None
+    if args.metrics:
+        import metrics
+        registry = metrics.metrics()
+        registry.serve(args.metrics)
+
+    try:
+        system = sEdge(host, config.get('port', 1502), discovery_cache=DISCOVERY_CACHE, metrics=registry)
+    except RuntimeError:
+        sys.exit(1)
+
+    writer = None
+    if args.capture:
+        import capture
+        writer = capture.capture_writer(args.capture)
+        writer.record(system)
+
+    store = None
+    sink = print_sink
+    if args.database:
+        import storage
+        store = storage.sqlite_store(args.database)
+        sink = store.sink
+
+    ledger = None
+    if args.energy:
+        import energy
+        ledger = energy.energy_ledger(args.energy)
+        sink = ledger.tee(sink)
+
+    try:
+        poller(system, config['groups'], sink).run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if ledger:
+            ledger.close()
+        if store:
+            store.close()
+        if writer:
+            writer.close()
@@ -23,14 +23,29 @@ import logging
 import os
 import sys
 import json
-from time import time
-from pyModbusTCP.client import ModbusClient
+import itertools
+import bisect
+import fnmatch
+from array import array
+from time import time, perf_counter
+import model_index
+import connections
 
 log = logging.getLogger(__name__)
 
 # locate the SunSpec JSON model files
 cwd = os.path.dirname(__file__)
-sunSpecModelPath = os.path.join(cwd,"models",'json')
+    # the models submodule, unless SUNSPEC_MODELS names another copy of the models' json directory
+sunSpecModelPath = os.environ.get('SUNSPEC_MODELS') or os.path.join(cwd,"models",'json')
+
+    # a single modbus read request is limited to 125 registers
+MAX_READ = 125
+    # number of unused registers that may be read to merge two spans into one request
+READ_GAP = 16
+    # cost of a read request round trip, in registers, when weighing requests against registers read;
+    # None compares the number of requests first and the registers read only between equal numbers,
+    # since the round trips dominate the time of a poll on most inverters
+REQUEST_COST = None
 
     # text is packed two characters per 16-bit modbus register
 def e_text(value):
@@ -43,8 +58,81 @@ def e_text(value):
     return result
     return bytes(b for i in value for b in [i>>8,i&0xFF]).decode(encoding='ascii')
 
+    # merge (address, count) register spans into the fewest read requests of at most max_read registers
+    # spans separated by no more than gap unused registers are read together unless
+    # doing so would require additional requests
+def plan_reads(spans, gap=READ_GAP, max_read=MAX_READ) :
+    def requests(count) :
+        return -(-count // max_read)
+
+    ranges = []
+    for (addr, count) in sorted(spans) :
+        if ranges :
+            (r_addr, r_count) = ranges[-1]
+            r_end = r_addr + r_count
+            end = max(r_end, addr + count)
+            if addr <= r_end or (addr - r_end <= gap and requests(end - r_addr) <= requests(r_count) + requests(count)) :
+                ranges[-1] = (r_addr, end - r_addr)
+                continue
+        ranges.append((addr, count))
+
+        # split the merged ranges into requests
+    reads = []
+    for (addr, count) in ranges :
+        while count > max_read :
+            reads.append((addr, max_read))
+            addr += max_read
+            count -= max_read
+        reads.append((addr, count))
+    return reads
+
+    # comparable cost of a set of reads: (requests, registers), or the registers plus request_cost per request
+def read_cost(reads, request_cost=REQUEST_COST) :
+    registers = sum(count for (addr, count) in reads)
+    if request_cost is None :
+        return (len(reads), registers)
+    return len(reads) * request_cost + registers
+
+    # extract a string point from the register values of a common (model 1) block
+def common_string(values, point_name) :
+    p = sEdge.load_model(1)['group']['point_index'][point_name]
+    return e_text(values[p['offset']:][:p['size']])
+
+    # device identity used to validate the discovery cache
+def fingerprint(common) :
+    if common is None :
+        return None
+    return {'SN': common_string(common, 'SN'), 'Vr': common_string(common, 'Vr'), 'common': list(common)}
+
+    # default location of the discovery cache
+DISCOVERY_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'modbus_solar', 'discovery.json')
+
+    # the discovery cache is a json file holding the headers of each host, keyed by "host:port"
+def read_discovery_cache(path) :
+    try :
+        with open(path) as f :
+            return json.load(f)
+    except FileNotFoundError :
+        return {}
+    except (OSError, ValueError) :
+        log.warning(f"Ignoring unreadable discovery cache {path}")
+        return {}
+
+def write_discovery_cache(path, cache) :
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temp = f'{path}.{os.getpid()}'
+    with open(temp, 'w') as f :
+        json.dump(cache, f)
+    os.replace(temp, path)
+
     # structure to hold information about each header encountered while parsing device modbus data
+    # registers, stamps and known are views into the register cache of the device (see register_cache);
+    # values is registers while they hold valid data, else None. A sparse refresh reads only some
+    # registers of a model, so known marks those that have been read from the device at all.
 class header :
+    __slots__ = ('ID', 'offset', 'length', 'Md', 'Opt', 'reference_count', 'members', 'values', 'spans',
+                 'common', 'registers', 'stamps', 'known')
+
     def __init__(self, ID, offset, length, Md=None) :
         self.ID = ID
         self.offset = offset
@@ -53,28 +141,405 @@ class header :
         self.Opt = None
         self.reference_count = 0
         self.members = []
-        self.values = []
+        self.values = None
+        self.spans = set()      # (relative offset, size) of the registers used by located points
+        self.common = None      # common header of the device a model belongs to
+        self.registers = None
+        self.stamps = None      # per register, the refresh in which its value last changed
+        self.known = None       # per register, 1 once it has been read; None if all registers are known
+
+    # one contiguous register buffer, and buffer of change stamps, for the headers of a device; each
+    # header's registers and stamps are views into them. Values already read (the common models)
+    # are copied in, so decoders always index the shared buffer rather than per-header lists.
+def register_cache(headers) :
+    if not headers :
+        return headers
+    base = min(h.offset for h in headers)
+    size = max(h.offset + h.length for h in headers) - base
+    registers = memoryview(array('H', bytes(2 * size)))
+    stamps = memoryview(array('Q', bytes(8 * size)))
+    known = memoryview(bytearray(size))
+    for h in headers :
+        start = h.offset - base
+        h.registers = registers[start:start + h.length]
+        h.stamps = stamps[start:start + h.length]
+        h.known = known[start:start + h.length]
+            # the model ID and length were read by discovery
+        h.registers[:2] = array('H', [h.ID, h.length - 2])
+        h.known[:2] = b'\x01\x01'
+        if h.values :
+            h.registers[:len(h.values)] = array('H', h.values)
+            h.known[:len(h.values)] = b'\x01' * len(h.values)
+            h.values = h.registers
+        else :
+            h.values = None
+    return headers
+
+    # headers replaced by a new discovery lose their data, so that points located on them fail to read
+    # (with an error) rather than returning their last values forever. The points are not moved to the
+    # new headers, whose models may have moved or gone: locate them again after a refresh_discovery().
+def retire_headers(headers) :
+    for h in headers or () :
+        h.values = None
+
+    # True if the registers of a header at the given relative addresses have been read from the device
+def registers_known(h, registers) :
+    known = h.known
+    return known is None or all(known[r] for r in registers)
+
+    # scale factor register value -> multiplier; 0x8000 (not implemented) scales by 1
+def scale_factor(sf_data) :
+    if sf_data == 0x8000 :
+        return 1
+    if sf_data & 0x8000 :
+        sf_data -= 65536
+    return 10**sf_data
+
+SCALE_FACTORS = {sf & 0xFFFF: scale_factor(sf & 0xFFFF) for sf in range(-20, 21)}
+SCALE_FACTORS[0x8000] = 1
+
+    # raw point decoders, by point type: (register values, offset) -> unscaled value, or None if not implemented
+def d_int16(values, offset) :
+    value = values[offset]
+    if value == 0x8000 :
+        return None
+    return value - 0x10000 if value & 0x8000 else value
+
+def d_uint16(values, offset) :
+    value = values[offset]
+    return None if value == 0xFFFF else value
+
+def d_acc16(values, offset) :
+    value = values[offset]
+    return None if value == 0x0000 else value
+
+def d_int32(values, offset) :
+    value = values[offset]<<16 | values[offset+1]
+    if value == 0x80000000 :
+        return None
+    return value - 0x100000000 if value & 0x80000000 else value
+
+def d_uint32(values, offset) :
+    value = values[offset]<<16 | values[offset+1]
+    return None if value == 0xFFFFFFFF else value
+
+def d_acc32(values, offset) :
+    value = values[offset]<<16 | values[offset+1]
+    return None if value == 0x00000000 else value
+
+def d_bitfield32(values, offset) :
+    value = values[offset]<<16 | values[offset+1]
+    return None if value == 0xFFFFFFFF else value
+
+raw_decoders = {
+    'int16': d_int16, 'uint16': d_uint16, 'acc16': d_acc16, 'enum16': d_uint16, 'bitfield16': d_uint16,
+    'sunssf': d_int16, 'int32': d_int32, 'uint32': d_uint32, 'acc32': d_acc32, 'bitfield32': d_bitfield32,
+}
+
+    # build (once per model point) a function decoding the point from a model's register values,
+    # returning (value, units) like extract_value
+def compile_decoder(model, point_name) :
+    decoders = model['group'].setdefault('decoders', {})
+    if point_name in decoders :
+        return decoders[point_name]
+
+    point_index = model['group']['point_index']
+    p = point_index[point_name]
+    p_type = p['type']
+    units = p.get('units')
+    offset = p['offset']
+    size = p['size']
+    symbol_table = p.get('symbol_table')
+    sf_offset = None
+    if 'sf' in p and p['sf'] in point_index :
+        sf_offset = point_index[p['sf']]['offset']
+
+    if p_type == 'string' :
+        def decode(values) :
+            return (e_text(values[offset:offset+size]), units)
+    elif p_type not in raw_decoders :
+        def decode(values) :
+            log.error(f"Unknown point type {p_type}")
+            return None
+    elif p_type in ('enum16', 'bitfield16', 'bitfield32') and symbol_table :
+        raw = raw_decoders[p_type]
+        if p_type == 'enum16' :
+            def decode(values) :
+                value = raw(values, offset)
+                return (None if value is None else symbol_table.get(value, value), units)
+        else :
+            def decode(values) :
+                value = raw(values, offset)
+                if value is None :
+                    return (None, units)
+                return ({name: (value>>bit) & 0x1 == 1 for (bit, name) in symbol_table.items()}, units)
+    elif sf_offset is not None :
+        raw = raw_decoders[p_type]
+        def decode(values) :
+            value = raw(values, offset)
+            if value is None :
+                return (None, units)
+            sf_data = values[sf_offset]
+            p_sf = SCALE_FACTORS.get(sf_data)
+            if p_sf is None :
+                p_sf = scale_factor(sf_data)
+            return (value * p_sf, units)
+    else :
+        raw = raw_decoders[p_type]
+        def decode(values) :
+            return (raw(values, offset), units)
+
+    decoders[point_name] = decode
+    return decode
+
+    # identifies each refresh for change detection
+refresh_stamps = itertools.count(1)
+
+    # (relative offset, size) of the registers needed to decode a point, including its scale factor
+def point_spans(model, point_name) :
+    point_index = model['group']['point_index']
+    p = point_index[point_name]
+    spans = [(p['offset'], p['size'])]
+    if 'sf' in p and p['sf'] in point_index :
+        spans.append((point_index[p['sf']]['offset'], 1))
+    return spans
+
+    # sentinel ("not implemented") raw values, by point type
+sentinels = {
+    'int16': 0x8000, 'uint16': 0xFFFF, 'acc16': 0x0000, 'enum16': 0xFFFF, 'bitfield16': 0xFFFF, 'sunssf': 0x8000,
+    'int32': 0x80000000, 'uint32': 0xFFFFFFFF, 'acc32': 0x00000000, 'bitfield32': 0xFFFFFFFF,
+}
+
+    # index arrays used by sEdge.decode_model to decode every numeric point of a model at once
+def compile_layout(model) :
+    group = model['group']
+    if 'layout' in group :
+        return group['layout']
+    import numpy as np
+
+    points = [p for p in group['points'] if p['type'] in sentinels]
+    point_index = group['point_index']
+    sf_offsets = [point_index[p['sf']]['offset'] if 'sf' in p and p['sf'] in point_index else -1 for p in points]
+    layout = {
+        'names': [p['name'] for p in points],
+        'offset': np.array([p['offset'] for p in points], dtype=np.intp),
+        'wide': np.array([p['size'] == 2 for p in points]),
+        'signed16': np.array([p['type'] in ('int16', 'sunssf') for p in points]),
+        'signed32': np.array([p['type'] == 'int32' for p in points]),
+        'sentinel': np.array([sentinels[p['type']] for p in points], dtype=np.int64),
+        'sf_offset': np.array([max(o, 0) for o in sf_offsets], dtype=np.intp),
+        'scaled': np.array([o >= 0 for o in sf_offsets]),
+    }
+    layout['dtype'] = np.dtype([(name, np.float64) for name in layout['names']])
+    layout['mask_dtype'] = np.dtype([(name, np.bool_) for name in layout['names']])
+    group['layout'] = layout
+    return layout
+
+    # Register access during discovery is written as generators that yield (address, count) read
+    # requests and are sent the register data (or None) in return, so that the same discovery code
+    # can be driven by a blocking client or awaited by an asyncio client
+
+    # drive a discovery generator with a blocking client and return its result
+def run_reads(client, steps) :
+    try :
+        request = next(steps)
+        while True :
+            request = steps.send(client.read_holding_registers(*request))
+    except StopIteration as e :
+        return e.value
+
+    # buffered reader used while walking the model headers; registers are read ahead in windows
+    # so that consecutive headers and common models are parsed from data already received
+class register_window :
+    def __init__(self, read_ahead=MAX_READ) :
+        self.read_ahead = read_ahead
+        self.addr = 0
+        self.data = []
+
+        # generator: yields the reads needed and returns the requested registers
+    def read(self, addr, count) :
+        if addr < self.addr or addr + count > self.addr + len(self.data) :
+            data = None
+            if self.read_ahead > count :
+                data = yield (addr, self.read_ahead)
+                    # reading ahead has run past the end of the register map - only read what is needed from now on
+                if data is None :
+                    self.read_ahead = 0
+            if data is None :
+                data = []
+                for (r_addr, r_count) in plan_reads([(addr, count)]) :
+                    r_data = yield (r_addr, r_count)
+                    if r_data is None :
+                        return None
+                    data += r_data
+            self.addr = addr
+            self.data = data
+        return self.data[addr - self.addr:][:count]
+
+    # index of device, model and point names for locate_point
+    # Device and model names may be abbreviated: the first header (in register order) whose name
+    # starts with the given text matches. Sorted name lists are searched with bisect and the
+    # results memoized, so resolving many points costs a dictionary lookup per repeated name.
+class lookup_index :
+    def __init__(self, headers) :
+        self.headers = headers
+        devices = []
+        self.models = {}                # id(common header) -> (sorted names, [(name, position, header)])
+        common = None
+        for (position, h) in enumerate(headers) :
+            if h.ID == 1 :
+                common = h
+                for name in {h.Md or '', h.Opt or ''} :
+                    devices.append((name, position, h))
+                self.models[id(h)] = []
+            elif common is not None :
+                self.models[id(common)].append((sEdge.models[h.ID]['group']['name'], position, h))
+        devices.sort(key=lambda e : (e[0], e[1]))
+        self.devices = ([e[0] for e in devices], devices)
+        for (key, entries) in self.models.items() :
+            entries.sort(key=lambda e : (e[0], e[1]))
+            self.models[key] = ([e[0] for e in entries], entries)
+        self.found = {}
+
+        # entries whose name starts with prefix
+    @staticmethod
+    def prefixed(table, prefix) :
+        (names, entries) = table
+        start = bisect.bisect_left(names, prefix)
+        end = start
+        while end < len(names) and names[end].startswith(prefix) :
+            end += 1
+        return entries[start:end]
+
+    def first(self, table, prefix) :
+        matches = lookup_index.prefixed(table, prefix)
+        if not matches :
+            return None
+        return min(matches, key=lambda e : e[1])[2]
+
+    def find_device(self, device_name) :
+        key = (None, device_name)
+        if key not in self.found :
+            self.found[key] = self.first(self.devices, device_name)
+        return self.found[key]
+
+    def find_model(self, common_header, model_name) :
+        key = (id(common_header), model_name)
+        if key not in self.found :
+            self.found[key] = self.first(self.models[id(common_header)], model_name)
+        return self.found[key]
+
+        # (common header, model header, point name) for each point matching a "device.model.point" pattern
+    def resolve(self, pattern) :
+        (device_name, model_name, point_name) = (pattern.split('.', maxsplit=2) + ['*', '*'])[:3]
+        if wildcard(device_name) :
+            commons = list({id(h): h for (name, position, h) in self.devices[1] if fnmatch.fnmatchcase(name, device_name)}.values())
+            commons.sort(key=lambda h : self.headers.index(h))
+        else :
+            commons = [h for h in [self.find_device(device_name)] if h is not None]
+        results = []
+        for c in commons :
+            if wildcard(model_name) :
+                members = sorted((e for e in self.models[id(c)][1] if fnmatch.fnmatchcase(e[0], model_name)), key=lambda e : e[1])
+                members = [e[2] for e in members]
+            else :
+                members = [h for h in [self.find_model(c, model_name)] if h is not None]
+            for m in members :
+                point_index = sEdge.models[m.ID]['group']['point_index']
+                if wildcard(point_name) :
+                    results += [(c, m, p) for p in point_index if fnmatch.fnmatchcase(p, point_name)]
+                elif point_name in point_index :
+                    results.append((c, m, point_name))
+        return results
+
+def wildcard(name) :
+    return any(c in name for c in '*?[')
 
     # methods for accessing SolarEdge devices
 verbose = False
 class sEdge :
     models = {}
+    metrics = None
+    capture = None          # capture.capture_writer recording the refreshes
+    base = 40000            # register address of the SunS marker
+    request_cost = REQUEST_COST
     
         # connect to inverter, discover models used, and map out register locations
-    def __init__(self, host, port):
+        # the discovered headers are saved to and restored from discovery_cache, if given
+        # the connection to (host, port, unit_id) is taken from pool (connections.pool by default), and
+        # shared with other systems of the process reading the same device
+        # pipeline > 1 sends up to that many read requests at once over the connection
+        # client replaces the Modbus client with any object providing read_holding_registers()
+        # base is the address of the SunS marker, for devices not using 40000 (see scanner.py)
+        # metrics, a metrics.metrics registry, enables instrumentation of requests, refreshes and decodes
+        # request_cost, the cost of a round trip in registers, weighs requests against registers when choosing
+        # between reading only the registers of located points and reading whole models (see REQUEST_COST)
+    def __init__(self, host, port, read_gap=READ_GAP, bulk_discovery=True, discovery_cache=None, pipeline=0, client=None,
+                 metrics=None, unit_id=1, pool=None, base=40000, request_cost=REQUEST_COST):
+        self.host = host
+        self.port = port
+        self.base = base
+        self.label = f'{host}:{port}'
+        self.metrics = metrics
+        self.read_gap = read_gap
+        self.request_cost = request_cost
+        self.bulk_discovery = bulk_discovery
+        self.discovery_cache = discovery_cache
+
             # establish connection
         try:
-            self.inverter = ModbusClient(host=host, port=port)
+            if client is not None :
+                self.inverter = client
+            else :
+                self.inverter = (pool or connections.pool).client(host, port, unit_id, pipeline)
         except ValueError:
             log.exception(f'Unable to connect to modbus client {host}:{port}')
             raise RuntimeError('Unable to connect to modbus client') from None
+        if metrics is not None :
+            self.inverter = metrics.client(self.inverter, self.label)
+
+        self.headers = None
+        if discovery_cache :
+            self.headers = self.load_discovery()
+        if self.headers is None :
+            self.refresh_discovery()
+
+    def window(self) :
+        return register_window(MAX_READ if self.bulk_discovery else 0)
 
+        # load a SunSpec model, adding relative point offsets, a point index and symbol tables
+        # models are taken from the precompiled model index when available
+    @classmethod
+    def load_model(cls, m_type) :
+        if m_type in cls.models :
+            return cls.models[m_type]
+        model = None
+        index = model_index.open_index()
+        if index is not None :
+            model = index.load(m_type)
+        if model is None :
+            try :
+                model = model_index.load_json_model(m_type, sunSpecModelPath)
+            except OSError :
+                log.exception(f"Unable to load SunSpec model {m_type}")
+                raise RuntimeError('Unable to load SunSpec model') from None
+        cls.models[m_type] = model
+        return model
+
+        # walk the model headers starting at reg_addr and return the headers list
+    def discover(self, reg_addr=40000) :
+        return run_reads(self.inverter, self.walk_headers(reg_addr))
+
+        # generator for discover()
+    def walk_headers(self, reg_addr=40000) :
             # register groups are identified by a "model identifier" from which specific registers can be located
             # The default start of the register groups is 40000, with the first two registers (16-bit) containing "SunS"
-        reg_addr = 40000
+
+            # discovery reads go through a read-ahead window unless bulk discovery is disabled
+        window = self.window()
 
             # verify the SunS identifier
-        m_data = self.inverter.read_holding_registers(reg_addr, 2)
+        m_data = yield from window.read(reg_addr, 2)
         if m_data==None :
             log.exception (f"Unable to read inverter holding register at offset {reg_addr}")
             raise RuntimeError('Unable to read inverter holding register') from None
@@ -85,12 +550,12 @@ class sEdge :
 
             # walk through the headers and add to the headers list
 
-        self.headers = []
+        headers = []
         current_common_header = None
         while True :
 
                 # read the model ID
-            m_data = self.inverter.read_holding_registers(reg_addr, 2)
+            m_data = yield from window.read(reg_addr, 2)
             if m_data==None :
                 log.exception (f"Unable to read model ID at register offset {reg_addr}")
                 raise RuntimeError('Unable to read model ID') from None
@@ -103,73 +568,118 @@ class sEdge :
             m_length = m_data[1]
 
                 # load model if needed
-            if m_type not in sEdge.models :
-                f = open(os.path.join(sunSpecModelPath,f'model_{m_type}.json'))
-                sEdge.models[m_type] = json.load(f)
-
-                    # build index and add relative offset information to model
-                point_index = {}
-                offset = 0
-                for p in sEdge.models[m_type]['group']['points'] :
-                    point_index[p['name']] = p
-                    p['offset'] = offset
-                        # create symbol table from symbols information, if present
-                    if 'symbols' in p :
-                        symbol_table = {}
-                        for s in p['symbols'] :
-                            symbol_table[s['value']] = s['name']
-                        p['symbol_table'] = symbol_table
-                    offset += p['size']
-                sEdge.models[m_type]['group']['point_index'] = point_index
-
-            self.headers.append(header(m_type, reg_addr, m_length+2))
+            model = sEdge.load_model(m_type)
+
+            headers.append(header(m_type, reg_addr, m_length+2))
 
                 # pick up device name and Option strings from the common header and add to header entry
             if m_type == 1 :
-                current_common_header = self.headers[-1]
-                m_data = self.inverter.read_holding_registers(reg_addr, m_length+2)
+                current_common_header = headers[-1]
+                m_data = yield from window.read(reg_addr, m_length+2)
                 if m_data==None :
                     log.exception (f"Unable to read common header info at register offset {reg_addr}")
                     raise RuntimeError('Unable to read common header info') from None
                 current_common_header.values = m_data
-                for p in sEdge.models[1]['group']['points'] :
-                    size = p['size']
-                    if p['name'] == "Md" :
-                        point_name = m_data[:size]
-                        point_name = e_text(point_name)
-                        self.headers[-1].Md = point_name
-                    if p['name'] == "Opt" :
-                        point_option = m_data[:size]
-                        point_option = e_text(point_option)
-                        self.headers[-1].Opt = point_option
-                    m_data = m_data[size:]
+                current_common_header.Md = common_string(m_data, 'Md')
+                current_common_header.Opt = common_string(m_data, 'Opt')
 
             else :
                 if current_common_header is None :
                     log.exception("Expected a common header before first model")
                     raise RuntimeError('Expected a common header before first model') from None
-                current_common_header.members.append(sEdge.models[m_type]['group']['name'])
+                current_common_header.members.append(model['group']['name'])
+            headers[-1].common = current_common_header
             reg_addr += m_length + 2
 
+        return register_cache(headers)
+
+        # walk the model headers again, updating the discovery cache; points located on the previous
+        # headers no longer read (see retire_headers) and must be located again
+    def refresh_discovery(self) :
+        start = perf_counter()
+        headers = self.discover(self.base)
+        retire_headers(self.headers)
+        self.headers = headers
+        if self.metrics is not None :
+            self.metrics.observe('discovery_seconds', perf_counter() - start, device=self.label, source='walk')
+        if self.discovery_cache :
+            self.save_discovery()
+
+        # identity of the device: the SunS marker and the contents of the first common model
+    def read_fingerprint(self, reg_addr=40000) :
+        return run_reads(self.inverter, self.fingerprint_reads(reg_addr))
+
+        # generator for read_fingerprint()
+    def fingerprint_reads(self, reg_addr=40000) :
+        window = self.window()
+        m_data = yield from window.read(reg_addr, 4)
+        if m_data is None or e_text(m_data[:2]) != "SunS" or m_data[2] != 1 :
+            return None
+        common = yield from window.read(reg_addr+2, m_data[3]+2)
+        return fingerprint(common)
+
+        # restore the headers saved for this host, provided the device fingerprint still matches
+    def load_discovery(self) :
+        start = perf_counter()
+        entry = self.cached_discovery()
+        headers = None
+        if entry is not None :
+            headers = self.restore_discovery(entry, self.read_fingerprint(self.base))
+        if self.metrics is not None :
+            result = 'miss' if entry is None else 'stale' if headers is None else 'hit'
+            self.metrics.count('discovery_cache_total', device=self.label, result=result)
+            if headers is not None :
+                self.metrics.observe('discovery_seconds', perf_counter() - start, device=self.label, source='cache')
+        return headers
+
+    def cached_discovery(self) :
+        return read_discovery_cache(self.discovery_cache).get(f'{self.host}:{self.port}')
+
+    def restore_discovery(self, entry, device_fingerprint) :
+        if device_fingerprint != entry['fingerprint'] :
+            log.info(f"Discovery cache for {self.host}:{self.port} is out of date")
+            return None
+
+        headers = []
+        current_common_header = None
+        for e in entry['headers'] :
+            sEdge.load_model(e['ID'])
+            h = header(e['ID'], e['offset'], e['length'])
+            h.Md = e['Md']
+            h.Opt = e['Opt']
+            h.members = e['members']
+            h.values = e['values']
+            if h.ID == 1 :
+                current_common_header = h
+            h.common = current_common_header
+            headers.append(h)
+        return register_cache(headers)
+
+    def save_discovery(self) :
+        if not self.headers or self.headers[0].ID != 1 :
+            log.error(f"No common model at the start of {self.host}:{self.port}; discovery not cached")
+            return
+        cache = read_discovery_cache(self.discovery_cache)
+        cache[f'{self.host}:{self.port}'] = {
+            'fingerprint': fingerprint(self.headers[0].values),
+            'headers': [{'ID': h.ID, 'offset': h.offset, 'length': h.length, 'Md': h.Md, 'Opt': h.Opt,
+                         'members': h.members, 'values': list(h.values or []) if h.ID==1 else []} for h in self.headers],
+        }
+        write_discovery_cache(self.discovery_cache, cache)
+
+        # remove this host from the discovery cache; the next construction will walk the headers
+    def invalidate_discovery(self) :
+        cache = read_discovery_cache(self.discovery_cache)
+        if cache.pop(f'{self.host}:{self.port}', None) is not None :
+            write_discovery_cache(self.discovery_cache, cache)
 
         # locate register using text description - used by point class creation
     def locate_point(self, device_name, model_name, point_name):
-        common_header = None
+        index = self.lookup()
+        common_header = index.find_device(device_name)
         member_header = None
-        for h in self.headers :
-                # first find a common header that matches device_name
-            if common_header==None :
-                if h.ID==1 and h.Md.startswith(device_name) :
-                    common_header = h
-                elif h.ID==1 and h.Opt.startswith(device_name) :
-                    common_header = h
-                # then find a model member that matches the model name
-            else :
-                if sEdge.models[h.ID]['group']['name'].startswith(model_name)  :
-                    member_header = h
-                    break
-                elif common_header!=None and h.ID==1 :
-                    break
+        if common_header is not None :
+            member_header = index.find_model(common_header, model_name)
         
             # was a matching common header found?
         if common_header==None :
@@ -191,136 +701,232 @@ class sEdge :
             return None
 
             # find the matching point within the points
-        point_names = list(sEdge.models[member_header.ID]['group']['point_index'].keys())
-        if point_name not in point_names :
+        point_index = sEdge.models[member_header.ID]['group']['point_index']
+        if point_name not in point_index :
             log.error(f"Unable to locate point named {point_name} in {model_name}")
             if verbose:
                 log.error(f' available parameters are:')
-                for pn in point_names:
+                for pn in point_index:
                     log.error(f'  {pn}')
             return None
 
-        log.debug("Found {point_name}")
+        log.debug("Found %s", point_name)
         member_header.reference_count += 1
 
+            # record the registers needed to decode the point, including its scale factor
+        member_header.spans.update(point_spans(sEdge.models[member_header.ID], point_name))
+
         return (member_header)
 
+        # name index of the current headers, rebuilt when the headers change
+    def lookup(self) :
+        index = getattr(self, 'index', None)
+        if index is None or index.headers is not self.headers :
+            index = self.index = lookup_index(self.headers)
+        return index
+
+        # "<system>.<subsystem>.<reg_name>" names (with Md, model name and point name in full) matching
+        # a pattern; each part may be abbreviated or contain * ? [] wildcards
+    def resolve(self, pattern) :
+        return [f'{c.Md}.{sEdge.models[m.ID]["group"]["name"]}.{p}' for (c, m, p) in self.lookup().resolve(pattern)]
+
         # (re)read all referenced devices to local "cache"
-    def refresh_readings(self):
+        # if a list of points is given only the models of those points are refreshed
+    def refresh_readings(self, points=None):
+        metrics = self.metrics
+        if metrics is not None :
+            start = perf_counter()
+        reads = self.plan_refresh(points)
+        if hasattr(self.inverter, 'read_many') :
+            results = self.inverter.read_many(reads)
+        else :
+            results = [self.inverter.read_holding_registers(addr, count) for (addr, count) in reads]
+        self.store_readings([(addr, count, data) for ((addr, count), data) in zip(reads, results)])
+        if metrics is not None :
+            metrics.observe('refresh_seconds', perf_counter() - start, device=self.label)
+            metrics.count('refresh_registers_total', sum(count for (addr, count) in reads), device=self.label)
+
+        # reads needed to refresh the referenced headers: either the complete model blocks or only the
+        # registers behind the located points, whichever is cheaper by read_cost
+    def plan_refresh(self, points=None) :
+        if points is None :
+            referenced = [h for h in self.headers if h.reference_count > 0]
+            spans = [(h.offset + o, size) for h in referenced for (o, size) in h.spans]
+        else :
+            referenced = list({id(p.header): p.header for p in points}.values())
+            spans = [(p.header.offset + o, size) for p in points for (o, size) in p.spans]
+        whole = plan_reads([(h.offset, h.length) for h in referenced], self.read_gap)
+        sparse = plan_reads(spans, self.read_gap)
+        return sparse if read_cost(sparse, self.request_cost) < read_cost(whole, self.request_cost) else whole
+
+        # distribute (address, count, data) read results to the headers; a failed read invalidates the headers it covers
+        # header.stamps records, per register, the refresh in which its value last changed so that
+        # points are only decoded again when one of their registers has changed
+    def store_readings(self, blocks) :
+        if self.capture is not None :
+            self.capture.write(self, blocks)
+        stamp = next(refresh_stamps)
         for h in self.headers :
-            if h.reference_count > 0 :
-                h.values = self.inverter.read_holding_registers(h.offset, h.length)
+            if h.reference_count == 0 :
+                continue
+            h_end = h.offset + h.length
+            covered = [(max(addr, h.offset), min(addr + count, h_end), addr, count, data)
+                       for (addr, count, data) in blocks if addr < h_end and addr + count > h.offset]
+            if not covered :
+                continue
+            failed = [(addr, count) for (start, end, addr, count, data) in covered if data is None]
+            if failed :
+                log.error(f"Unable to read {failed[0][1]} registers at offset {failed[0][0]}")
+                h.values = None
+                continue
+            if h.registers is None :
+                register_cache(self.headers)
+            registers = h.registers
+            stamps = h.stamps
+            if h.values is None :
+                stamps[:] = array('Q', [stamp]) * h.length
+            for (start, end, addr, count, data) in covered :
+                new = array('H', data[start - addr:end - addr])
+                (first, last) = (start - h.offset, end - h.offset)
+                h.known[first:last] = b'\x01' * (last - first)
+                if registers[first:last] != new :
+                    for (i, (a, b)) in enumerate(zip(registers[first:last], new), first) :
+                        if a != b :
+                            stamps[i] = stamp
+                    registers[first:last] = new
+            h.values = registers
 
         # extract register value from cache and format - used by point.read_point()
     def extract_value(self, header, point_name) :
         if header.values==None :
             log.error (f"No register data to extract {point_name} from")
             return None
-        p = sEdge.models[header.ID]['group']['point_index'][point_name]
-        p_type = p['type']
-        if 'units' in p :
-            p_units = p['units']
-        else :
-            p_units = None
-        if 'sf' in p :
-            sf_name = p['sf']
-            sf_point = sEdge.models[header.ID]['group']['point_index'][sf_name]
-            sf_offset = sf_point['offset']
-            sf_data = header.values[sf_offset]
-            log.debug(f"Scale factor: {sf_data}")
-            if sf_data == 32768 :
-                p_sf = 0
-            elif sf_data & 0x8000 :
-                p_sf = sf_data - 65536
-            else :
-                p_sf = sf_data
-            p_sf = 10**p_sf
-            log.debug("Scale factor: {p_sf}")
-        else :
-            p_sf = None
-        p_data = header.values[p['offset']:][:p['size']]
-
-        log.debug(f'{p_data=}, {p_type=}')
-        if   p_type == 'int16':
-            if p_data[0] == 0x8000 :
-                value = None
-            elif p_data[0] & 0x8000 :
-                value = (p_data[0]-65536) * p_sf
-            else :
-                value = p_data[0] * p_sf
-        elif p_type == 'uint16':
-            if p_data[0] == 0xFFFF :
-                value = None
-            else :
-                value = p_data[0] * p_sf
-        elif p_type == 'acc16':
-            if p_data[0] == 0x0000 :
-                value = None
-            else :
-                value = p_data[0] * p_sf
-        elif p_type == 'enum16' :
-            if p_data[0] == 0xFFFF:
-                value = None
-            elif 'symbol_table' in p :
-                value = p['symbol_table'][p_data[0]]
-            else :
-                value = p_data[0]
-
-        elif p_type == 'int32' :
-            value = p_data[0]<<16 | p_data[1]
-            if value == 0x80000000:
-                value = None
-            else:
-                value = (value-0xFFFFFFFF) * p_sf
-        elif p_type == 'uint32' :
-            value = p_data[0]<<16 | p_data[1]
-            if value == 0xFFFFFFFF:
-                value = None
-            else:
-                value = value * p_sf
-        elif p_type == 'acc32' :
-            value = p_data[0]<<16 | p_data[1]
-            if value == 0x00000000:
-                value = None
-            else:
-                value = value * p_sf
-        elif p_type == 'bitfield32' :
-            log.debug(f'{p_data=}')
-            value = p_data[0]<<16 | p_data[1]
-            if value==0xFFFFFFFF :
-                value = None
-            elif 'symbol_table' in p :
-                bit_values = {}
-                for s in p['symbol_table'] :
-                    bit = (value>>s) & 0x1
-                    bit_values[p['symbol_table'][s]] = (bit==1)
-                value = bit_values
-            else :
-                value = p_data[0]<<16 | p_data[1]
-            pass
+        model = sEdge.models[header.ID]
+        if not registers_known(header, [o + i for (o, size) in point_spans(model, point_name) for i in range(size)]) :
+            log.error (f"The registers of {point_name} have not been read")
+            return None
+        return compile_decoder(model, point_name)(header.values)
+
+        # decode every numeric point of a model block at once into a one-record numpy structured array
+        # with a float64 field per point; scale factors are applied and "not implemented" values are NaN,
+        # or masked when masked is set (numpy.ma is considerably slower on structured arrays)
+    def decode_model(self, header, masked=False) :
+        if header.values is None :
+            log.error (f"No register data to decode model {header.ID} from")
+            return None
+        try :
+            import numpy as np
+        except ImportError :
+            raise RuntimeError('decode_model requires numpy') from None
+        start = perf_counter()
+        layout = compile_layout(sEdge.models[header.ID])
 
+        raw = np.asarray(header.values, dtype=np.int64)
+        offset = layout['offset']
+        wide = layout['wide']
+        word = np.where(wide, raw[offset] << 16 | raw[np.minimum(offset + 1, len(raw) - 1)], raw[offset])
+        missing = word == layout['sentinel']
+        if header.known is not None :
+                # registers not read by a sparse refresh
+            known = np.frombuffer(header.known, dtype=np.uint8) != 0
+            missing |= ~known[offset] | (wide & ~known[np.minimum(offset + 1, len(raw) - 1)]) \
+                        | (layout['scaled'] & ~known[layout['sf_offset']])
+        value = word - (layout['signed16'] & (word >= 0x8000)) * 0x10000 \
+                     - (layout['signed32'] & (word >= 0x80000000)) * 0x100000000
 
-        elif p_type == 'string' :
-            value = e_text(p_data)
+        sf = raw[layout['sf_offset']]
+        sf = np.where(layout['scaled'] & (sf != 0x8000), sf - (sf >= 0x8000) * 0x10000, 0)
+        value = value * np.power(10.0, sf)
+
+        if masked :
+            result = np.ma.MaskedArray(value.view(layout['dtype']), mask=missing.view(layout['mask_dtype']))
         else :
-            log.error(f"Unknown point type {p_type}")
-            return None
+            value[missing] = np.nan
+            result = value.view(layout['dtype'])
+        if self.metrics is not None :
+            self.metrics.observe('model_decode_seconds', perf_counter() - start, device=self.label, model=header.ID)
+        return result
 
-        return (value, p_units)
+        # reference a complete model block so that refresh_readings reads all of it
+    def reference_model(self, header) :
+        header.reference_count += 1
+        header.spans.add((0, header.length))
 
     # methods for reading registers
 class point:
-    
-    def __init__(self, server, device_name, model_name, point_name) :
+    __slots__ = ('server', 'point_name', 'header', 'decode', 'spans', 'registers', 'deadband', 'deadband_pct',
+                 'value', 'decoded', 'published')
+
+        # deadband (absolute) and deadband_pct (percent of the last published value) limit
+        # read_changed() to meaningful changes
+    def __init__(self, server, device_name, model_name, point_name, deadband=None, deadband_pct=None) :
         self.server = server
         self.point_name = point_name
         self.header = server.locate_point(device_name, model_name, point_name)
         if self.header is None:
             raise RuntimeError('Unable to locate data point') from None
-        
+        self.decode = compile_decoder(sEdge.models[self.header.ID], point_name)
+        self.spans = point_spans(sEdge.models[self.header.ID], point_name)
+        self.registers = [o + i for (o, size) in self.spans for i in range(size)]
+        self.deadband = deadband
+        self.deadband_pct = deadband_pct
+        self.value = None           # cached decode
+        self.decoded = None         # (values, stamp) the cached decode was made from
+        self.published = None       # last value returned by read_changed()
+
+        # True if the point's registers changed since it was last decoded
+    def dirty(self) :
+        values = self.header.values
+        stamps = self.header.stamps
+        if self.decoded is None or stamps is None or values is not self.decoded[0] :
+            return True
+        return max(map(stamps.__getitem__, self.registers)) > self.decoded[1]
+
     def read_point(self, refresh=False) :
-        value = self.server.extract_value(self.header, self.point_name)
-        return value
+        values = self.header.values
+        if values is None :
+            log.error (f"No register data to extract {self.point_name} from")
+            return None
+        metrics = self.server.metrics
+        if self.dirty() :
+            if not registers_known(self.header, self.registers) :
+                log.error (f"The registers of {self.point_name} have not been read")
+                return None
+            if metrics is None :
+                self.value = self.decode(values)
+            else :
+                start = perf_counter()
+                self.value = self.decode(values)
+                metrics.observe('decode_seconds', perf_counter() - start, device=self.server.label, model=self.header.ID)
+                metrics.count('point_reads_total', device=self.server.label, result='miss')
+            stamps = self.header.stamps
+            self.decoded = (values, max(map(stamps.__getitem__, self.registers)) if stamps else 0)
+        elif metrics is not None :
+            metrics.count('point_reads_total', device=self.server.label, result='hit')
+        return self.value
+
+        # (value, units) if the value moved outside the deadband since it was last returned, else None
+    def read_changed(self) :
+        reading = self.read_point()
+        if reading is None :
+            return None
+        if self.published is not None and not self.outside_deadband(self.published[0], reading[0]) :
+            return None
+        self.published = reading
+        return reading
+
+    def outside_deadband(self, previous, value) :
+        if value == previous :
+            return False
+        numeric = (int, float)
+        if not (isinstance(value, numeric) and isinstance(previous, numeric)) :
+            return True
+        change = abs(value - previous)
+        if self.deadband is not None and change <= self.deadband :
+            return False
+        if self.deadband_pct is not None and change <= abs(previous) * self.deadband_pct / 100 :
+            return False
+        return True
 
 epilog = """
 <system> is the Manufacturer (Mn) or Model (Md) of the associated common header
@@ -328,6 +934,7 @@ epilog = """
 <registers> is register name within the subsystem
 
 Abbreviated text values will match the first occurance
+Wildcards (* ? []) select all matching registers, e.g. Export.ac_meter.TotWh*
 """
 if __name__ == '__main__' :
     import argparse
@@ -343,8 +950,14 @@ if __name__ == '__main__' :
         nargs='*')
     parser.add_argument("--ip_address", help="IP address of the inverter",
         default=default_ip)
+    parser.add_argument("--port", help="Modbus/TCP port of the inverter",
+        type=int, default=1502)
     parser.add_argument("--list", help="list all available registers in system",
         action="store_true")
+    parser.add_argument("--rediscover", help="ignore the discovery cache and walk the model headers",
+        action="store_true")
+    parser.add_argument("--base", help="register address of the SunS marker (see scanner.py)",
+        type=int, default=40000)
 
     args = parser.parse_args()
     print(args.ip_address)
@@ -352,9 +965,13 @@ if __name__ == '__main__' :
 #   system = sEdge('solaredgeinv.local', 1502)
 #   system = sEdge('192.168.1.67', 1502)
     try:
-        system = sEdge(args.ip_address, 1502)
+        system = sEdge(args.ip_address, args.port, discovery_cache=None if args.rediscover else DISCOVERY_CACHE,
+                       base=args.base)
     except RuntimeError:
         sys.exit()
+    if args.rediscover:
+        system.discovery_cache = DISCOVERY_CACHE
+        system.save_discovery()
 
     if args.list:
         for h in system.headers :
@@ -365,7 +982,10 @@ if __name__ == '__main__' :
     else:
         points = {}
         if args.registers:
+            registers = []
             for register in args.registers:
+                registers += system.resolve(register) if wildcard(register) else [register]
+            for register in registers:
                 (device, module, reg) = register.split('.', maxsplit=3)
                 try:
                     p = point(system, device, module, reg)
@@ -382,4 +1002,33 @@ if __name__ == '__main__' :
                 else:
                     print(f'{p} {value}')
         else:
-            pass    # TODO add code to dump all?
+                # dump all models of all devices
+            for h in system.headers :
+                if h.ID != 1 :
+                    system.reference_model(h)
+            system.refresh_readings()
+
+            for h in system.headers :
+                if h.ID == 1 :
+                    print(h.Md, h.Opt)
+                    continue
+                group = sEdge.models[h.ID]['group']
+                print(f" {group['name']}")
+                if h.values is None :
+                    continue
+                try :
+                    record = system.decode_model(h)
+                except RuntimeError :
+                    record = None
+                for p in group['points'] :
+                    if record is not None and p['type'] in sentinels and 'symbol_table' not in p :
+                        value = record[p['name']][0]
+                        if value != value :                         # NaN is not implemented
+                            value = None
+                        elif p.get('sf') not in group['point_index'] :
+                            value = int(value)                      # unscaled points are integers
+                    elif p['type'] in raw_decoders or p['type'] == 'string' :
+                        (value, units) = system.extract_value(h, p['name'])
+                    else :
+                        continue
+                    print(f"  {p['name']:16} {value} {p.get('units') or ''}")
@@ -0,0 +1,224 @@
+'''
+Register map scanner for unknown devices
+
+Maps the readable holding registers of a device and the SunSpec model chains in them, in
+place of dump.py's register-by-register sweep:
+  - the candidate SunSpec base addresses (0, 40000, 50000) are probed for the SunS marker
+    and their model chains walked, with read-ahead as in sEdge discovery
+  - the address range is read in blocks of 125 registers; blocks that fail are halved until
+    the pieces read or are no longer than resolution registers (so readable ranges of about
+    twice the resolution or more are found), and where a failed piece borders a readable one
+    the exact boundary is found by bisection
+  - reads are spread over several connections to the device, at most concurrency at a time
+    and max_requests in total; a scan that runs out of requests is marked incomplete
+
+The result is a json map:
+    {"host", "port", "unit_id", "time", "seconds", "requests", "complete", "range": [start, end],
+     "readable": [[start, end], ...],
+     "sunspec": [{"base", "end", "models": [{"ID", "offset", "length", ("Mn", "Md", "SN")}]}]}
+with end addresses exclusive, and model offset and length as in sEdge headers (from the model ID,
+including the two header registers). A chain whose walk failed has an end of null.
+
+sEdge discovery can be seeded with the base found:
+    system = sEdge(host, port, base=sunspec_base(load_map('device.json')))
+
+    python scanner.py <host>[:<port>] ... [--unit_id <n>] [--concurrency <n>] [--sunspec_only] [--output <file>]
+'''
+import asyncio
+import logging
+import sys
+import json
+from time import time, monotonic
+
+from sEdge import MAX_READ, register_window, e_text, common_string
+from async_sEdge import run_reads
+import mbtcp
+
+log = logging.getLogger(__name__)
+
+SUNSPEC_BASES = (0, 40000, 50000)
+REGISTERS = 0x10000
+    # longest model chain walked before the chain is considered corrupt
+MAX_MODELS = 256
+
+    # scan of one device; reads go through a pool of concurrency connections
+class device_scan :
+    def __init__(self, host, port=502, unit_id=1, concurrency=4, max_requests=20000, timeout=1.0, resolution=16) :
+        self.host = host
+        self.port = port
+        self.unit_id = unit_id
+        self.concurrency = concurrency
+        self.resolution = resolution
+        self.max_requests = max_requests
+        self.timeout = timeout
+        self.requests = 0
+        self.exhausted = False
+        self.idle = None
+
+        # register values, or None if unreadable or the request budget is spent
+    async def read_holding_registers(self, addr, count) :
+        if self.requests >= self.max_requests :
+            self.exhausted = True
+            return None
+        self.requests += 1
+        client = await self.idle.get()
+        try :
+            return await client.read_holding_registers(addr, count)
+        finally :
+            self.idle.put_nowait(client)
+
+    async def readable(self, addr, count) :
+        return count == 0 or await self.read_holding_registers(addr, count) is not None
+
+    async def run(self, start=0, end=REGISTERS, sunspec_only=False) :
+        began = monotonic()
+        self.idle = asyncio.Queue()
+        clients = [mbtcp.async_client(self.host, self.port, self.unit_id, self.timeout) for i in range(self.concurrency)]
+        for client in clients :
+            self.idle.put_nowait(client)
+        try :
+            chains = await asyncio.gather(*(run_reads(self, walk_chain(base)) for base in SUNSPEC_BASES))
+            ranges = [] if sunspec_only else await self.sweep(start, end)
+        finally :
+            for client in clients :
+                client.close()
+        return {
+            'host': self.host, 'port': self.port, 'unit_id': self.unit_id, 'time': time(),
+            'seconds': monotonic() - began, 'requests': self.requests, 'complete': not self.exhausted,
+            'range': None if sunspec_only else [start, end],
+            'readable': ranges, 'sunspec': [c for c in chains if c is not None],
+        }
+
+        # readable [start, end) ranges of the address range
+    async def sweep(self, start, end) :
+        blocks = [(addr, min(MAX_READ, end - addr)) for addr in range(start, end, MAX_READ)]
+        pieces = [piece for tiles in await asyncio.gather(*(self.tile(addr, count) for (addr, count) in blocks))
+                  for piece in tiles]
+
+        ranges = [[addr, addr + count] for (addr, count, good) in pieces if good]
+        searches = []
+        for (i, (addr, count, good)) in enumerate(pieces) :
+            if good :
+                continue
+            if i > 0 and pieces[i-1][2] :
+                searches.append(self.readable_prefix(addr, count))
+            if i + 1 < len(pieces) and pieces[i+1][2] :
+                searches.append(self.readable_suffix(addr, count))
+        ranges += [r for r in await asyncio.gather(*searches) if r[1] > r[0]]
+        return merge(ranges)
+
+        # (address, count, readable) pieces covering a block, halving the pieces that fail
+    async def tile(self, addr, count) :
+        if await self.readable(addr, count) :
+            return [(addr, count, True)]
+        if count <= self.resolution or self.exhausted :
+            return [(addr, count, False)]
+        half = count // 2
+        (left, right) = await asyncio.gather(self.tile(addr, half), self.tile(addr + half, count - half))
+        return left + right
+
+        # bisect for the longest readable [addr, addr+k) of a block known to fail as a whole
+    async def readable_prefix(self, addr, count) :
+        (good, bad) = (0, count)
+        while bad - good > 1 :
+            middle = (good + bad) // 2
+            if await self.readable(addr, middle) :
+                good = middle
+            else :
+                bad = middle
+        return [addr, addr + good]
+
+        # bisect for the longest readable [s, addr+count) of a block known to fail as a whole
+    async def readable_suffix(self, addr, count) :
+        end = addr + count
+        (bad, good) = (addr, end)
+        while good - bad > 1 :
+            middle = (good + bad) // 2
+            if await self.readable(middle, end - middle) :
+                good = middle
+            else :
+                bad = middle
+        return [good, end]
+
+def merge(ranges) :
+    merged = []
+    for (start, end) in sorted(ranges) :
+        if merged and start <= merged[-1][1] :
+            merged[-1][1] = max(merged[-1][1], end)
+        else :
+            merged.append([start, end])
+    return merged
+
+    # generator (see sEdge.run_reads) walking the SunSpec model chain at base; None if there is no SunS marker
+def walk_chain(base) :
+    window = register_window()
+    marker = yield from window.read(base, 2)
+    if marker is None or e_text(marker) != 'SunS' :
+        return None
+    models = []
+    addr = base + 2
+    while len(models) < MAX_MODELS and addr + 2 <= REGISTERS :
+        m_data = yield from window.read(addr, 2)
+        if m_data is None :
+            break
+        if m_data[0] == 0xFFFF :
+            return {'base': base, 'end': addr + 2, 'models': models}
+        model = {'ID': m_data[0], 'offset': addr, 'length': m_data[1] + 2}
+        if m_data[0] == 1 :
+            values = yield from window.read(addr, m_data[1] + 2)
+            if values is not None :
+                for name in ('Mn', 'Md', 'SN') :
+                    model[name] = common_string(values, name)
+        models.append(model)
+        addr += m_data[1] + 2
+    log.warning(f"SunSpec model chain at {base} is broken at {addr}")
+    return {'base': base, 'end': None, 'models': models}
+
+    # scan many (host, port) devices concurrently, each within its own budget
+async def scan_hosts(hosts, start=0, end=REGISTERS, sunspec_only=False, **kwargs) :
+    return await asyncio.gather(*(device_scan(host, port, **kwargs).run(start, end, sunspec_only) for (host, port) in hosts))
+
+def load_map(path) :
+    with open(path) as f :
+        return json.load(f)
+
+    # SunS marker address of the first complete chain of a scan, or None
+def sunspec_base(scan_map) :
+    for chain in scan_map['sunspec'] :
+        if chain['end'] is not None :
+            return chain['base']
+    return None
+
+if __name__ == '__main__' :
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="map the readable registers and SunSpec models of devices")
+    parser.add_argument("hosts", help="<host>[:<port>] of each device", nargs='+')
+    parser.add_argument("--unit_id", help="Modbus unit ID", type=int, default=1)
+    parser.add_argument("--concurrency", help="requests in flight per device", type=int, default=4)
+    parser.add_argument("--max_requests", help="request budget per device", type=int, default=20000)
+    parser.add_argument("--resolution", help="smallest failed piece of a block that is split again", type=int, default=16)
+    parser.add_argument("--timeout", help="seconds to wait for each reply", type=float, default=1.0)
+    parser.add_argument("--start", help="first register address to sweep", type=int, default=0)
+    parser.add_argument("--end", help="register address ending the sweep", type=int, default=REGISTERS)
+    parser.add_argument("--sunspec_only", help="only walk the SunSpec model chains", action="store_true")
+    parser.add_argument("--output", help="write the map(s) to this file instead of stdout")
+    args = parser.parse_args()
+
+    hosts = []
+    for h in args.hosts :
+        (host, _, port) = h.partition(':')
+        hosts.append((host, int(port) if port else 502))
+
+    maps = asyncio.run(scan_hosts(hosts, args.start, args.end, args.sunspec_only, unit_id=args.unit_id,
+                                  concurrency=args.concurrency, max_requests=args.max_requests, timeout=args.timeout,
+                                  resolution=args.resolution))
+    result = maps[0] if len(maps) == 1 else maps
+    if args.output :
+        with open(args.output, 'w') as f :
+            json.dump(result, f, indent=1)
+    else :
+        json.dump(result, sys.stdout, indent=1)
+        print()
@@ -0,0 +1,292 @@
+'''
+Modbus/TCP SunSpec simulator
+
+Serves a SunSpec register map over Modbus/TCP so that sEdge and the applications built on it
+can be exercised, benchmarked and regression tested without an inverter.
+
+The register map is built from the SunSpec JSON models for a list of devices, or loaded from
+a register dump in the format printed by dump.py ("<hex address>: <hex words>..."). The
+server can add latency and jitter, limit the registers per request, drop replies, answer
+pipelined requests one at a time, and keep the readings changing.
+
+    python simulator.py --device SE10K:inverter:101,802 --device Export:meter:203 --listen 1502
+    python sEdge.py --ip_address 127.0.0.1 --list
+
+Devices are given as <Md>:<Opt>:<model ids>.
+'''
+import asyncio
+import logging
+import sys
+import random
+import struct
+import threading
+
+from sEdge import sEdge, MAX_READ
+import mbtcp
+
+log = logging.getLogger(__name__)
+
+ILLEGAL_DATA_ADDRESS = 2
+ILLEGAL_DATA_VALUE = 3
+
+    # text packed two characters per register
+def text_registers(text, size) :
+    data = text.encode('ascii')[:2*size].ljust(2*size, b'\0')
+    return [data[i]<<8 | data[i+1] for i in range(0, 2*size, 2)]
+
+    # register values for a model with plausible point values; returns (values, live offsets)
+    # live offsets are the (offset, type) of measurements that change over time
+def model_registers(m_type, common=None) :
+    points = sEdge.load_model(m_type)['group']['points']
+    length = sum(p['size'] for p in points)
+    values = []
+    live = []
+    for p in points :
+        p_type = p['type']
+        size = p['size']
+        if p['name'] == 'ID' :
+            data = [m_type]
+        elif p['name'] == 'L' :
+            data = [length - 2]
+        elif common is not None and p['name'] in common :
+            data = text_registers(common[p['name']], size) if p_type == 'string' else [common[p['name']]]
+        elif p_type == 'string' :
+            data = text_registers(p.get('label', p['name']), size)
+        elif p_type == 'sunssf' :
+            data = [0xFFFF]                 # -1
+        elif p_type == 'pad' :
+            data = [0x8000] * size
+        elif p_type in ('enum16', 'enum32') :
+            data = [0] * (size - 1) + [p['symbols'][0]['value'] if p.get('symbols') else 0]
+        elif p_type in ('bitfield16', 'bitfield32', 'count') :
+            data = [0] * size
+        elif p_type in ('acc32', 'uint32') :
+            value = random.randint(100000, 10000000)
+            data = [value >> 16, value & 0xFFFF]
+            live.append((len(values), p_type))
+        elif p_type in ('int16', 'uint16') :
+            data = [random.randint(100, 5000)]
+            live.append((len(values), p_type))
+        else :
+            data = [0] * size
+        values += data
+    return (values, live)
+
+    # registers of a SunSpec device chain at base: {address: value} and the live (address, type) list
+    # devices is a list of (Md, Opt, [model ids])
+def build_registers(devices, base=40000) :
+    registers = {}
+    live = []
+    addr = base
+    for value in text_registers('SunS', 2) :
+        registers[addr] = value
+        addr += 1
+    for (n, (md, opt, models)) in enumerate(devices) :
+        common = {'Mn': 'SolarEdge', 'Md': md, 'Opt': opt, 'Vr': '0004.0023', 'SN': f'SIM{n:05}', 'DA': 1}
+        for m_type in [1] + list(models) :
+            (values, model_live) = model_registers(m_type, common if m_type == 1 else None)
+            live += [(addr + offset, p_type) for (offset, p_type) in model_live]
+            for value in values :
+                registers[addr] = value
+                addr += 1
+    registers[addr] = 0xFFFF
+    registers[addr+1] = 0
+    return (registers, live)
+
+    # registers from a dump.py style listing
+def load_dump(f) :
+    registers = {}
+    for line in f :
+        (addr, _, words) = line.partition(':')
+        try :
+            addr = int(addr, 16)
+        except ValueError :
+            continue
+        for word in words.split() :
+            if len(word) != 4 :
+                break
+            try :
+                registers[addr] = int(word, 16)
+            except ValueError :
+                break
+            addr += 1
+    return registers
+
+class simulator :
+    def __init__(self, registers, live=(), latency=0.0, jitter=0.0, max_read=MAX_READ, drop=0.0,
+                 pipelining=True, change_interval=1.0) :
+        self.registers = registers
+        self.live = list(live)
+        self.latency = latency
+        self.jitter = jitter
+        self.max_read = max_read
+        self.drop = drop
+        self.pipelining = pipelining
+        self.change_interval = change_interval
+        self.stats = {'connections': 0, 'requests': 0, 'registers': 0, 'bytes_in': 0, 'bytes_out': 0,
+                      'exceptions': 0, 'dropped': 0}
+        self.server = None
+
+    def reset_stats(self) :
+        for key in self.stats :
+            self.stats[key] = 0
+
+        # random walk of the live measurements; counters only increase
+    def change(self) :
+        for (addr, p_type) in self.live :
+            if p_type in ('acc32', 'uint32') :
+                value = (self.registers[addr] << 16 | self.registers[addr+1]) + random.randint(0, 100)
+                self.registers[addr] = (value >> 16) & 0xFFFF
+                self.registers[addr+1] = value & 0xFFFF
+            else :
+                value = self.registers[addr] + random.randint(-50, 50)
+                self.registers[addr] = min(max(value, 0), 0x7FFF)
+
+    def reply(self, pdu) :
+        (function, addr, count) = struct.unpack('>BHH', pdu[:5])
+        if function != mbtcp.READ_HOLDING_REGISTERS :
+            return bytes([function | 0x80, 1])
+        if count < 1 or count > self.max_read :
+            return bytes([function | 0x80, ILLEGAL_DATA_VALUE])
+        data = [self.registers.get(a) for a in range(addr, addr + count)]
+        if None in data :
+            return bytes([function | 0x80, ILLEGAL_DATA_ADDRESS])
+        self.stats['registers'] += count
+        return bytes([function, 2*count]) + struct.pack(f'>{count}H', *data)
+
+    async def transaction(self, writer, tid, unit_id, pdu) :
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0 :
+            await asyncio.sleep(delay)
+        if self.drop and random.random() < self.drop :
+            self.stats['dropped'] += 1
+            return
+        reply = self.reply(pdu)
+        if reply[0] & 0x80 :
+            self.stats['exceptions'] += 1
+        frame = mbtcp.MBAP.pack(tid, 0, len(reply) + 1, unit_id) + reply
+        self.stats['bytes_out'] += len(frame)
+        writer.write(frame)
+
+    async def connection(self, reader, writer) :
+        self.stats['connections'] += 1
+        pending = set()
+        try :
+            while True :
+                (tid, protocol, length, unit_id) = mbtcp.MBAP.unpack(await reader.readexactly(mbtcp.MBAP.size))
+                pdu = await reader.readexactly(length - 1)
+                self.stats['requests'] += 1
+                self.stats['bytes_in'] += mbtcp.MBAP.size + len(pdu)
+                if self.pipelining :
+                    task = asyncio.ensure_future(self.transaction(writer, tid, unit_id, pdu))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+                else :
+                    await self.transaction(writer, tid, unit_id, pdu)
+        except (asyncio.IncompleteReadError, ConnectionError, struct.error, asyncio.CancelledError) :
+            pass
+        finally :
+            for task in pending :
+                task.cancel()
+            writer.close()
+
+    async def changing(self) :
+        while True :
+            await asyncio.sleep(self.change_interval)
+            self.change()
+
+    async def start(self, host='127.0.0.1', port=1502) :
+        self.server = await asyncio.start_server(self.connection, host, port)
+        if self.live and self.change_interval :
+            asyncio.ensure_future(self.changing())
+        return self.server.sockets[0].getsockname()[1]
+
+    async def serve(self, host='127.0.0.1', port=1502) :
+        port = await self.start(host, port)
+        log.info(f"Simulating {len(self.registers)} registers on {host}:{port}")
+        await self.server.serve_forever()
+
+        # run the simulator on its own event loop in a daemon thread; returns the port it listens on
+        # (port 0 picks a free port)
+    def start_thread(self, host='127.0.0.1', port=0) :
+        loop = asyncio.new_event_loop()
+        started = threading.Event()
+        result = {}
+
+        def run() :
+            asyncio.set_event_loop(loop)
+            result['port'] = loop.run_until_complete(self.start(host, port))
+            started.set()
+            loop.run_forever()
+
+        self.thread = threading.Thread(target=run, name='simulator', daemon=True)
+        self.thread.start()
+        started.wait()
+        self.loop = loop
+        return result['port']
+
+    async def shutdown(self) :
+        self.server.close()
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in tasks :
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop_thread(self) :
+        asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    # parse a <Md>:<Opt>:<model ids> device description
+def parse_device(text) :
+    (md, opt, models) = text.split(':')
+    return (md, opt, [int(m) for m in models.split(',') if m])
+
+if __name__ == '__main__' :
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="serve a simulated SunSpec register map over Modbus/TCP")
+    parser.add_argument("--device", help="<Md>:<Opt>:<model ids> of a simulated device (repeatable)",
+        action='append', default=[])
+    parser.add_argument("--dump", help="serve the registers of a dump.py register dump")
+    parser.add_argument("--base", help="register address of the SunS marker",
+        type=int, default=40000)
+    parser.add_argument("--host", help="address to listen on",
+        default='127.0.0.1')
+    parser.add_argument("--listen", help="port to listen on",
+        type=int, default=1502)
+    parser.add_argument("--latency", help="seconds before each reply",
+        type=float, default=0.0)
+    parser.add_argument("--jitter", help="additional random delay of up to this many seconds",
+        type=float, default=0.0)
+    parser.add_argument("--max_read", help="registers allowed per request",
+        type=int, default=MAX_READ)
+    parser.add_argument("--drop", help="probability of not replying to a request",
+        type=float, default=0.0)
+    parser.add_argument("--serial", help="answer pipelined requests one at a time",
+        action="store_true")
+    parser.add_argument("--change_interval", help="seconds between changes of the readings (0 for static)",
+        type=float, default=1.0)
+    args = parser.parse_args()
+
+    if args.dump:
+        with open(args.dump) as f:
+            (registers, live) = (load_dump(f), [])
+    else:
+        devices = [parse_device(d) for d in args.device] or [('SE10K', 'inverter', [101, 802]), ('Export', 'meter', [203])]
+        try:
+            (registers, live) = build_registers(devices, args.base)
+        except RuntimeError:
+            sys.exit(1)
+
+    sim = simulator(registers, live, args.latency, args.jitter, args.max_read, args.drop,
+                    not args.serial, args.change_interval)
+    try:
+        asyncio.run(sim.serve(args.host, args.listen))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,256 @@
+'''
+Shared-memory snapshot of polled registers
+
+Inverters accept few concurrent Modbus/TCP clients and answer slowly, so one process polls
+the device and publishes the raw register blocks to a multiprocessing.shared_memory segment;
+any number of local readers decode from that segment without network I/O.
+
+Segment layout:
+    0   uint64      sequence number, odd while the writer is updating (seqlock)
+    8   float64     time of the last publish
+    16  uint32      length of the json metadata
+    20  uint32      number of headers
+    24  json        headers: ID, offset, length, Md, Opt, members, position of their registers
+        uint8[n]    1 if the header's registers are valid
+        uint8[]     per register of all headers, 1 if it has been read (see sEdge.header.known)
+        uint16[]    register values of all headers
+
+Readers take the sequence number, decode, and retry if it changed meanwhile, backing off while
+an update is in progress. A reader that finds no consistent snapshot within its timeout (the
+publisher was killed in the middle of an update) raises RuntimeError. snapshot_sEdge
+is a drop-in sEdge for locating and reading points:
+
+    system = snapshot_sEdge('192.168.12.186', 1502)
+    soc = point(system, "Export", "DERStorageCapacity", "SoC")
+    (value, units) = system.read_points([soc])[0]
+
+Run the publisher with
+    python snapshot.py [--ip_address <address>] [--interval <seconds>]
+'''
+import logging
+import sys
+import json
+import struct
+from multiprocessing import shared_memory
+from time import time, sleep, monotonic
+
+from sEdge import sEdge, header, DISCOVERY_CACHE
+
+log = logging.getLogger(__name__)
+
+HEAD = struct.Struct('=QdII')
+    # seconds a reader waits for a consistent snapshot; a publish takes microseconds, so a longer
+    # update means the publisher stopped in the middle of one
+SNAPSHOT_TIMEOUT = 1.0
+    # first and longest sleep between checks of a snapshot that is being updated
+MIN_BACKOFF = 0.00001
+MAX_BACKOFF = 0.01
+
+def segment_name(host, port) :
+    return 'modbus_solar_' + ''.join(c if c.isalnum() else '_' for c in f'{host}_{port}')
+
+def align(n) :
+    return (n + 7) & ~7
+
+    # attach to an existing segment without the resource tracker unlinking it when this process exits
+def attach(name) :
+    try :
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError :
+        shm = shared_memory.SharedMemory(name)
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+    # the parts of a mapped segment
+class segment :
+    def __init__(self, shm) :
+        self.shm = shm
+        (seq, published, meta_length, count) = HEAD.unpack_from(shm.buf, 0)
+        self.meta = json.loads(bytes(shm.buf[HEAD.size:HEAD.size+meta_length]))
+        flags_start = align(HEAD.size + meta_length)
+        self.flags = shm.buf[flags_start:flags_start+count]
+        registers = sum(m['length'] for m in self.meta)
+        known_start = align(flags_start + count)
+        self.known = shm.buf[known_start:known_start+registers]
+        data_start = align(known_start + registers)
+        self.data = shm.buf[data_start:data_start+2*registers].cast('H')
+
+    def sequence(self) :
+        return struct.unpack_from('=Q', self.shm.buf, 0)[0]
+
+    def release(self) :
+        self.flags.release()
+        self.known.release()
+        self.data.release()
+
+    # publishes the headers of a polled sEdge
+class snapshot_writer :
+    def __init__(self, system, name=None) :
+        self.system = system
+        self.name = name or segment_name(system.host, system.port)
+        meta = []
+        position = 0
+        for h in system.headers :
+            meta.append({'ID': h.ID, 'offset': h.offset, 'length': h.length, 'Md': h.Md, 'Opt': h.Opt,
+                         'members': h.members, 'position': position})
+            position += h.length
+        meta_data = json.dumps(meta).encode()
+        size = align(align(align(HEAD.size + len(meta_data)) + len(meta)) + position) + 2*position
+
+        try :
+            old = shared_memory.SharedMemory(self.name)
+            old.close()
+            old.unlink()
+        except FileNotFoundError :
+            pass
+        self.shm = shared_memory.SharedMemory(self.name, create=True, size=size)
+        HEAD.pack_into(self.shm.buf, 0, 0, 0.0, len(meta_data), len(meta))
+        self.shm.buf[HEAD.size:HEAD.size+len(meta_data)] = meta_data
+        self.segment = segment(self.shm)
+        self.sequence = 0
+
+        # copy the current register values of the system into the segment
+    def publish(self) :
+        self.sequence += 1
+        struct.pack_into('=Q', self.shm.buf, 0, self.sequence)       # odd: update in progress
+        for (i, (h, m)) in enumerate(zip(self.system.headers, self.segment.meta)) :
+            valid = h.values is not None
+            if valid :
+                self.segment.data[m['position']:m['position']+h.length] = h.values
+                self.segment.known[m['position']:m['position']+h.length] = h.known if h.known is not None \
+                                                                           else b'\x01' * h.length
+            self.segment.flags[i] = valid
+        self.sequence += 1
+        struct.pack_into('=Qd', self.shm.buf, 0, self.sequence, time())
+
+        # poller sink
+    def sink(self, timestamp, group, samples) :
+        self.publish()
+
+    def close(self) :
+        self.segment.release()
+        self.shm.close()
+        self.shm.unlink()
+
+    # sEdge reading from a published snapshot; header values are views into the shared memory
+    # timeout is the longest wait for a consistent snapshot before RuntimeError is raised
+class snapshot_sEdge(sEdge) :
+    def __init__(self, host, port, name=None, read_gap=None, timeout=SNAPSHOT_TIMEOUT) :
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.inverter = None
+        self.shm = attach(name or segment_name(host, port))
+        self.segment = segment(self.shm)
+
+        self.headers = []
+        self.views = []
+        current_common_header = None
+        for m in self.segment.meta :
+            self.views.append(self.segment.data[m['position']:m['position']+m['length']])
+            sEdge.load_model(m['ID'])
+            h = header(m['ID'], m['offset'], m['length'])
+            h.known = self.segment.known[m['position']:m['position']+m['length']]
+            h.Md = m['Md']
+            h.Opt = m['Opt']
+            h.members = m['members']
+            if h.ID == 1 :
+                current_common_header = h
+            h.common = current_common_header
+            self.headers.append(h)
+        self.sequence = None
+        self.refresh_readings()
+
+        # wait for a consistent snapshot and point the headers at it; no data is copied
+    def refresh_readings(self, points=None, deadline=None) :
+        if deadline is None :
+            deadline = monotonic() + self.timeout
+        delay = MIN_BACKOFF
+        while True :
+            sequence = self.segment.sequence()
+            if not sequence & 1 :
+                for (i, (h, view)) in enumerate(zip(self.headers, self.views)) :
+                    h.values = view if self.segment.flags[i] else None
+                if self.segment.sequence() == sequence :
+                    self.sequence = sequence
+                    return
+            if monotonic() >= deadline :
+                self.stale()
+            sleep(delay)
+            delay = min(delay * 2, MAX_BACKOFF)
+
+        # give up on a snapshot that stays inconsistent: its data is dropped and RuntimeError raised
+    def stale(self) :
+        for h in self.headers :
+            h.values = None
+        self.sequence = None
+        published = self.published()
+        age = f'last published {time() - published:.1f} seconds ago' if published else 'never published'
+        log.error(f"No consistent snapshot of {self.host}:{self.port} within {self.timeout} seconds; {age}")
+        raise RuntimeError('No consistent snapshot') from None
+
+        # True if the snapshot has not been updated since refresh_readings()
+    def consistent(self) :
+        return self.segment.sequence() == self.sequence
+
+    def published(self) :
+        return struct.unpack_from('=d', self.shm.buf, 8)[0]
+
+        # read a list of points from one consistent snapshot
+    def read_points(self, points) :
+        deadline = monotonic() + self.timeout
+        while True :
+            self.refresh_readings(deadline=deadline)
+            readings = [p.read_point() for p in points]
+            if self.consistent() :
+                return readings
+            for p in points :
+                p.decoded = None
+            if monotonic() >= deadline :
+                self.stale()
+
+    def close(self) :
+        for h in self.headers :
+            h.values = None
+            h.known.release()
+            h.known = None
+        for view in self.views :
+            view.release()
+        self.segment.release()
+        self.shm.close()
+
+if __name__ == '__main__' :
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="poll all models of a device and publish them to shared memory")
+    parser.add_argument("--ip_address", help="IP address of the inverter",
+        default='192.168.12.186')
+    parser.add_argument("--port", help="Modbus/TCP port of the inverter",
+        type=int, default=1502)
+    parser.add_argument("--interval", help="seconds between polls",
+        type=float, default=1.0)
+    args = parser.parse_args()
+
+    try:
+        system = sEdge(args.ip_address, args.port, discovery_cache=DISCOVERY_CACHE)
+    except RuntimeError:
+        sys.exit(1)
+    for h in system.headers:
+        system.reference_model(h)
+
+    writer = snapshot_writer(system)
+    log.info(f'Publishing {args.ip_address}:{args.port} to {writer.name}')
+    try:
+        next_poll = time()
+        while True:
+            system.refresh_readings()
+            writer.publish()
+            next_poll += args.interval
+            sleep(max(next_poll - time(), 0))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.close()
@@ -0,0 +1,174 @@
+'''
+Historical storage of polled point values
+
+Samples are buffered in memory and written to SQLite in batches, one transaction per
+flush, so that a collector polling every second does not write to its storage (often an
+SD card) for every sample. The database runs in WAL mode.
+
+Each series is identified by the device Md/Opt, the model name and the point name; the
+samples table holds (series, time, value). Background maintenance rolls the raw samples up
+into per-interval min/max/sum/count rows and deletes raw samples older than the retention
+period.
+
+    store = sqlite_store('solar.db')
+    poller(system, groups, sink=store.sink).run()
+'''
+import logging
+import sqlite3
+import threading
+from time import time
+
+from sEdge import sEdge
+
+log = logging.getLogger(__name__)
+
+schema = '''
+CREATE TABLE IF NOT EXISTS series (
+    id INTEGER PRIMARY KEY,
+    device TEXT NOT NULL,
+    option TEXT NOT NULL,
+    model TEXT NOT NULL,
+    point TEXT NOT NULL,
+    units TEXT,
+    UNIQUE (device, option, model, point)
+);
+CREATE TABLE IF NOT EXISTS samples (
+    series INTEGER NOT NULL,
+    time REAL NOT NULL,
+    value REAL,
+    PRIMARY KEY (series, time)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rollups (
+    series INTEGER NOT NULL,
+    interval INTEGER NOT NULL,
+    time INTEGER NOT NULL,
+    min REAL,
+    max REAL,
+    sum REAL,
+    count INTEGER,
+    PRIMARY KEY (series, interval, time)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS watermarks (
+    interval INTEGER PRIMARY KEY,
+    time INTEGER NOT NULL
+);
+'''
+
+    # (device, option, model, point) identifying the series of a located point
+def series_key(p) :
+    common = p.header.common
+    return (common.Md if common else '', common.Opt if common else '',
+            sEdge.models[p.header.ID]['group']['name'], p.point_name)
+
+class sqlite_store :
+        # flush_interval: seconds between batch writes (or batch_size samples, whichever is first)
+        # rollups: intervals in seconds to roll raw samples up into
+        # retention: seconds to keep raw samples; None keeps them forever
+    def __init__(self, path, flush_interval=60.0, batch_size=10000, rollups=(60, 3600, 86400),
+                 retention=7*86400, maintenance_interval=600.0) :
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.rollups = rollups
+        self.retention = retention
+        self.maintenance_interval = maintenance_interval
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(schema)
+        self.db_lock = threading.Lock()
+
+        self.series = {}            # series_key -> id
+        self.buffer = []
+        self.buffer_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closing = False
+        self.worker = threading.Thread(target=self.background, name='sqlite_store', daemon=True)
+        self.worker.start()
+
+    def series_id(self, p, units) :
+        key = series_key(p)
+        sid = self.series.get(key)
+        if sid is None :
+            with self.db_lock, self.db :
+                self.db.execute('INSERT OR IGNORE INTO series (device, option, model, point, units) VALUES (?, ?, ?, ?, ?)',
+                                key + (units,))
+                sid = self.db.execute('SELECT id FROM series WHERE device=? AND option=? AND model=? AND point=?',
+                                      key).fetchone()[0]
+            self.series[key] = sid
+        return sid
+
+        # buffer a (value, units) reading of a point; non-numeric values are not stored
+    def add(self, timestamp, p, reading) :
+        if reading is None :
+            return
+        (value, units) = reading
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))) :
+            return
+        sample = (self.series_id(p, units), timestamp, value)
+        with self.buffer_lock :
+            self.buffer.append(sample)
+            full = len(self.buffer) >= self.batch_size
+        if full :
+            self.wakeup.set()
+
+        # poller sink
+    def sink(self, timestamp, group, samples) :
+        for (name, p, reading) in samples :
+            self.add(timestamp, p, reading)
+
+        # write the buffered samples in one transaction
+    def flush(self) :
+        with self.buffer_lock :
+            (batch, self.buffer) = (self.buffer, [])
+        if not batch :
+            return 0
+        with self.db_lock, self.db :
+            self.db.executemany('INSERT OR REPLACE INTO samples (series, time, value) VALUES (?, ?, ?)', batch)
+        return len(batch)
+
+        # roll completed intervals up and apply the retention period
+    def maintain(self, now=None) :
+        if now is None :
+            now = time()
+        self.flush()
+        with self.db_lock, self.db :
+            for interval in self.rollups :
+                row = self.db.execute('SELECT time FROM watermarks WHERE interval=?', (interval,)).fetchone()
+                if row is None :
+                    row = self.db.execute('SELECT min(time) FROM samples').fetchone()
+                    if row[0] is None :
+                        continue
+                    start = int(row[0] // interval * interval)
+                else :
+                    start = row[0]
+                end = int(now // interval * interval)
+                if end <= start :
+                    continue
+                self.db.execute('''INSERT OR REPLACE INTO rollups (series, interval, time, min, max, sum, count)
+                    SELECT series, ?1, CAST(time / ?1 AS INTEGER) * ?1, min(value), max(value), sum(value), count(value)
+                    FROM samples WHERE time >= ?2 AND time < ?3 GROUP BY series, CAST(time / ?1 AS INTEGER)''',
+                    (interval, start, end))
+                self.db.execute('INSERT OR REPLACE INTO watermarks (interval, time) VALUES (?, ?)', (interval, end))
+            if self.retention is not None :
+                self.db.execute('DELETE FROM samples WHERE time < ?', (now - self.retention,))
+
+    def background(self) :
+        next_maintenance = time() + self.maintenance_interval
+        while not self.closing :
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try :
+                self.flush()
+                if time() >= next_maintenance :
+                    self.maintain()
+                    next_maintenance = time() + self.maintenance_interval
+            except sqlite3.Error :
+                log.exception("Unable to write samples")
+
+    def close(self) :
+        self.closing = True
+        self.wakeup.set()
+        self.worker.join()
+        self.flush()
+        self.db.close()
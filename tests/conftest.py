@@ -0,0 +1,37 @@
+import os
+import sys
+import random
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import simulator
+import bench
+import model_index
+from sEdge import sEdge, sunSpecModelPath
+
+if not (os.path.isdir(sunSpecModelPath) or os.path.exists(model_index.MODEL_INDEX)) :
+    pytest.exit(f'No SunSpec models at {sunSpecModelPath}: run "git submodule update --init" or set SUNSPEC_MODELS',
+                returncode=4)
+
+    # (registers, live) of one inverter with a meter, with reproducible readings
+@pytest.fixture
+def installation() :
+    random.seed(1)
+    return simulator.build_registers([('SE10K', 'inverter', [101, 203])])
+
+    # sEdge reading the installation from memory
+@pytest.fixture
+def system(installation) :
+    (registers, live) = installation
+    return sEdge('memory', 0, client=bench.memory_client(registers))
+
+    # the installation served over Modbus/TCP: (simulator, port)
+@pytest.fixture
+def served(installation) :
+    (registers, live) = installation
+    sim = simulator.simulator(registers, live, change_interval=0)
+    port = sim.start_thread()
+    yield (sim, port)
+    sim.stop_thread()
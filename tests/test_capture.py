@@ -0,0 +1,76 @@
+import bench
+import simulator
+from capture import capture_writer, replay_client, read_capture, READINGS
+from sEdge import sEdge, point
+
+NAMES = [('inverter', 'W'), ('inverter', 'WH'), ('ac_meter', 'A'), ('ac_meter', 'TotWhImp')]
+
+def record(system, path, refreshes, between=None) :
+    writer = capture_writer(path)
+    writer.record(system)
+    for i in range(refreshes) :
+        system.refresh_readings()
+        if between is not None :
+            between(i)
+    writer.close()
+
+def replay(path, names) :
+    client = replay_client(path)
+    system = sEdge('replay', 0, client=client)
+    points = [point(system, 'SE10K', model, name) for (model, name) in names]
+    readings = []
+    while True :
+        system.refresh_readings()
+        if client.ended :
+            return readings
+        readings.append([p.read_point() for p in points])
+
+def test_capture_replays_the_recorded_readings(installation, tmp_path) :
+    (registers, live) = installation
+    sim = simulator.simulator(registers, live)
+    system = sEdge('memory', 0, client=bench.memory_client(registers))
+    points = [point(system, 'SE10K', model, name) for (model, name) in NAMES]
+    recorded = []
+    def refreshed(i) :
+        recorded.append([p.read_point() for p in points])
+        sim.change()
+    path = tmp_path / 'site.cap'
+    record(system, path, 5, refreshed)
+    assert system.capture is None
+    system.refresh_readings()            # no longer recorded
+
+    assert sum(frame[0] == READINGS for frame in read_capture(path)) == 5
+    assert replay(path, NAMES) == recorded
+
+def test_registers_not_captured_are_not_made_up(system, tmp_path) :
+    point(system, 'SE10K', 'inverter', 'W')
+    path = tmp_path / 'site.cap'
+    record(system, path, 2)
+    readings = replay(path, [('inverter', 'A')])
+    assert readings == [[None], [None]]
+
+def test_failed_blocks_are_not_served_from_earlier_refreshes(installation, tmp_path) :
+    (registers, live) = installation
+    client = bench.memory_client(registers)
+    system = sEdge('memory', 0, client=client)
+    w = point(system, 'SE10K', 'inverter', 'W')
+    addr = w.header.offset + 14
+    saved = registers[addr]
+    def fail_second(i) :
+        if i == 0 :
+            del registers[addr]         # the next refresh of W fails
+        else :
+            registers[addr] = saved
+    path = tmp_path / 'site.cap'
+    record(system, path, 3, fail_second)
+    readings = [r[0] for r in replay(path, [('inverter', 'W')])]
+    assert readings[0] is not None and readings[2] is not None
+    assert readings[1] is None
+
+def test_truncated_capture_is_read_to_the_last_complete_record(system, tmp_path) :
+    point(system, 'SE10K', 'inverter', 'W')
+    path = tmp_path / 'site.cap'
+    record(system, path, 3)
+    data = path.read_bytes()
+    path.write_bytes(data[:-3])
+    assert sum(frame[0] == READINGS for frame in read_capture(path)) == 2
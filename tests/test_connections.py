@@ -0,0 +1,90 @@
+import logging
+
+import pytest
+
+import connections
+import metrics
+import mbtcp
+
+    # a device that answers while up, and times out otherwise
+class device :
+    def __init__(self) :
+        self.up = False
+        self.attempts = 0
+        self.last_error = mbtcp.NO_ERROR
+
+    def read_holding_registers(self, addr, count) :
+        self.attempts += 1
+        self.last_error = mbtcp.NO_ERROR if self.up else mbtcp.TIMEOUT_ERROR
+        return [0] * count if self.up else None
+
+    def close(self) :
+        pass
+
+    # a pipelined client that repeated one request and had one batch time out inside read_many
+class pipelined_device(device) :
+    def __init__(self) :
+        super().__init__()
+        self.up = True
+        self.retries = 0
+        self.timeouts = 0
+
+    def read_many(self, reads) :
+        self.retries += 1
+        self.timeouts += 1
+        return [[0] * count for (addr, count) in reads]
+
+@pytest.fixture
+def clock(monkeypatch) :
+    now = [1000.0]
+    monkeypatch.setattr(connections, 'monotonic', lambda: now[0])
+    return now
+
+def test_backoff_and_circuit_breaker(clock) :
+    pool = connections.connection_pool(retries=1, backoff=1.0, max_backoff=60.0, failure_threshold=3, reset_timeout=30.0)
+    inverter = device()
+    client = connections.managed_client(pool, inverter, 'test')
+
+    assert client.read_holding_registers(40000, 2) is None
+    assert (inverter.attempts, client.retries, client.timeouts) == (2, 1, 2)
+        # backing off for 1 second: refused without contacting the device
+    assert client.read_holding_registers(40000, 2) is None
+    assert (inverter.attempts, client.rejected) == (2, 1)
+    clock[0] += 1.0
+    assert client.read_holding_registers(40000, 2) is None
+    assert inverter.attempts == 4
+    assert client.status()['retry_in'] == 2.0
+
+    clock[0] += 2.0
+    assert client.read_holding_registers(40000, 2) is None
+    assert client.circuit_open
+    assert client.status()['retry_in'] == 30.0
+        # an open circuit is probed once, without retries
+    clock[0] += 30.0
+    assert client.read_holding_registers(40000, 2) is None
+    assert inverter.attempts == 7
+
+    inverter.up = True
+    clock[0] += 30.0
+    assert client.read_holding_registers(40000, 2) == [0, 0]
+    assert not client.circuit_open
+    assert client.read_holding_registers(40000, 2) == [0, 0]
+
+def test_counters_include_the_wrapped_pipelined_client() :
+    pool = connections.connection_pool()
+    registry = metrics.metrics()
+    client = registry.client(connections.managed_client(pool, pipelined_device(), 'test'), 'test')
+    client.read_many([(40000, 2), (40010, 2)])
+    stats = {name: values[0]['value'] for (name, values) in registry.stats().items() if name.endswith('_total')}
+    assert stats == {'modbus_requests_total': 2, 'modbus_retries_total': 1, 'modbus_timeouts_total': 1}
+
+def test_pipeline_mode_of_an_existing_connection_is_kept(caplog) :
+    pool = connections.connection_pool()
+    pipelined = pool.client('127.0.0.1', 15020, pipeline=4)
+    with caplog.at_level(logging.WARNING, logger='connections') :
+        assert pool.client('127.0.0.1', 15020) is pipelined
+    assert 'pipeline=0 is ignored' in caplog.text
+    caplog.clear()
+    assert pool.client('127.0.0.1', 15020, pipeline=8) is pipelined
+    assert not caplog.text
+    pool.close()
@@ -0,0 +1,47 @@
+import pytest
+
+import bench
+from sEdge import sEdge, point
+
+@pytest.fixture
+def inverter(installation) :
+    (registers, live) = installation
+    system = sEdge('memory', 0, client=bench.memory_client(registers))
+    def power(deadband=None, deadband_pct=None) :
+        w = point(system, 'SE10K', 'inverter', 'W', deadband=deadband, deadband_pct=deadband_pct)
+        registers[w.header.offset + 15] = 0         # W_SF: watts
+        def reading(watts) :
+            registers[w.header.offset + 14] = watts
+            system.refresh_readings()
+            value = w.read_changed()
+            return None if value is None else value[0]
+        reading.point = w
+        return reading
+    return power
+
+def test_every_change_is_published_without_a_deadband(inverter) :
+    reading = inverter()
+    assert [reading(w) for w in (100, 100, 101, 101, 100)] == [100, None, 101, None, 100]
+
+def test_absolute_deadband(inverter) :
+    reading = inverter(deadband=10)
+    assert [reading(w) for w in (100, 110, 90, 111, 101, 100)] == [100, None, None, 111, None, 100]
+
+def test_percent_deadband_is_relative_to_the_last_published_value(inverter) :
+    reading = inverter(deadband_pct=5)
+        # 5% of 1000 is 50; after 1051 is published, 5% of 1051 is 52.55
+    assert [reading(w) for w in (1000, 1050, 1051, 1100, 1103, 1104)] == [1000, None, 1051, None, None, 1104]
+
+def test_either_deadband_suppresses_a_change(inverter) :
+    reading = inverter(deadband=20, deadband_pct=1)
+    assert [reading(w) for w in (1000, 1015, 1021, 1030, 1042)] == [1000, None, 1021, None, 1042]
+
+def test_failed_reads_are_not_published(installation, inverter) :
+    (registers, live) = installation
+    reading = inverter(deadband=10)
+    assert reading(100) == 100
+    addr = reading.point.header.offset + 15
+    saved = registers.pop(addr)         # W_SF: the read of W fails
+    assert reading(200) is None
+    registers[addr] = saved
+    assert [reading(w) for w in (105, 200)] == [None, 200]
@@ -0,0 +1,46 @@
+import bench
+import metrics
+from sEdge import sEdge, point
+
+    # the first register of the serial number in the common model of the installation
+SN = 40000 + 2 + 2 + 48
+
+def cache_results(registry) :
+    return {c['labels']['result']: c['value'] for c in registry.stats().get('discovery_cache_total', [])}
+
+def connect(registers, path, registry) :
+    return sEdge('memory', 0, client=bench.memory_client(registers), discovery_cache=str(path), metrics=registry)
+
+def test_discovery_cache_hit_stale_and_invalidate(installation, tmp_path) :
+    (registers, live) = installation
+    path = tmp_path / 'discovery.json'
+    registry = metrics.metrics()
+    walked = connect(registers, path, registry)
+    assert cache_results(registry) == {'miss': 1}
+
+    cached = connect(registers, path, registry)
+    assert cache_results(registry) == {'miss': 1, 'hit': 1}
+    assert [(h.ID, h.offset, h.length) for h in cached.headers] == [(h.ID, h.offset, h.length) for h in walked.headers]
+    assert cached.headers[0].values.tolist() == walked.headers[0].values.tolist()
+
+        # another device at the same address: the fingerprint no longer matches
+    registers[SN] += 1
+    connect(registers, path, registry)
+    assert cache_results(registry) == {'miss': 1, 'hit': 1, 'stale': 1}
+
+    connect(registers, path, registry).invalidate_discovery()
+    connect(registers, path, registry)
+    assert cache_results(registry)['miss'] == 2
+
+def test_points_on_replaced_headers_fail_to_read(system) :
+    w = point(system, 'SE10K', 'inverter', 'W')
+    system.refresh_readings()
+    assert w.read_point() is not None
+
+    system.refresh_discovery()
+    system.refresh_readings()
+    assert w.read_point() is None
+
+    w = point(system, 'SE10K', 'inverter', 'W')
+    system.refresh_readings()
+    assert w.read_point() is not None
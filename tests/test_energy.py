@@ -0,0 +1,54 @@
+import pytest
+
+import energy
+
+T0 = 1_000_000_020.0
+
+def test_wraparound_is_counted() :
+    s = energy.series(1 << 16)
+    s.add(T0, 65530, 1)
+    assert s.add(T0 + 10, 65535, 1) == 5
+    assert s.add(T0 + 20, 9, 1) == 10
+    assert (s.total, s.wraps, s.resets) == (15, 1, 0)
+
+def test_reset_restarts_the_count() :
+    s = energy.series(1 << 32)
+    s.add(T0, 100000, 1)
+    s.add(T0 + 10, 100100, 1)
+    assert s.add(T0 + 20, 50, 1) == 0
+    assert s.add(T0 + 30, 80, 1) == 30
+    assert (s.total, s.resets) == (130, 1)
+
+def test_implausible_jump_is_a_reset() :
+    s = energy.series(1 << 32, max_rate=10)
+    s.add(T0, 1000, 1)
+    assert s.add(T0 + 10, 1000000, 1) == 0
+    assert s.resets == 1
+
+def test_missed_samples_are_spread_over_the_gap() :
+    s = energy.series(1 << 32, max_gap=300)
+    s.add(T0, 1000, 1)               # on a minute boundary
+    assert s.add(T0 + 10, None, 1) == 0
+    assert s.add(T0 + 600, 1600, 1) == 600
+    minutes = s.rollups[60].buckets
+    assert s.missed == 1
+    assert len(minutes) == 10
+    assert all(energy == pytest.approx(60) and estimated == pytest.approx(60) for (start, energy, estimated) in minutes)
+    assert sum(e for (start, e, est) in s.rollups[3600].buckets) == pytest.approx(600)
+
+def test_scale_factor_change() :
+    s = energy.series(1 << 32)
+    s.add(T0, 100, 10)
+    assert s.add(T0 + 10, 11, 100) == 100
+
+def test_ledger_round_trip(tmp_path) :
+    path = tmp_path / 'energy.json'
+    ledger = energy.energy_ledger(str(path))
+    ledger.series['meter'] = s = energy.series(1 << 32)
+    s.add(T0, 100, 1)
+    s.add(T0 + 30, 160, 1)
+    ledger.close()
+    restored = energy.energy_ledger(str(path))
+    assert restored.status() == ledger.status()
+    assert restored.rollup('meter', 60) == ledger.rollup('meter', 60)
+    assert restored.totals(86400, T0) == {'meter': 60}
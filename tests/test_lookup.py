@@ -0,0 +1,69 @@
+import fnmatch
+import random
+
+import pytest
+
+import bench
+import simulator
+from sEdge import sEdge, lookup_index
+
+@pytest.fixture
+def headers() :
+    random.seed(1)
+    (registers, live) = simulator.build_registers([('SE10K', 'inverter', [101, 203]), ('Export', 'meter', [203, 201]),
+                                                   ('SE10K-2', 'second', [103, 124])])
+    return sEdge('memory', 0, client=bench.memory_client(registers)).headers
+
+def model_name(h) :
+    return sEdge.models[h.ID]['group']['name']
+
+    # the scan locate_point made before the index: first matching device, then its first matching model
+def linear_find(headers, device_name, model_name_prefix) :
+    common = None
+    for h in headers :
+        if common is None :
+            if h.ID == 1 and (h.Md.startswith(device_name) or h.Opt.startswith(device_name)) :
+                common = h
+        elif h.ID == 1 :
+            break
+        elif model_name(h).startswith(model_name_prefix) :
+            return (common, h)
+    return (common, None)
+
+def prefixes(names) :
+    return sorted({name[:n] for name in names for n in range(len(name) + 1)} | {'x', 'SE10K-3'})
+
+def test_prefix_lookup_matches_the_linear_scan(headers) :
+    index = lookup_index(headers)
+    devices = [text for h in headers if h.ID == 1 for text in (h.Md, h.Opt)]
+    models = [model_name(h) for h in headers if h.ID != 1]
+    for device in prefixes(devices) :
+        for model in prefixes(models) :
+            (common, member) = linear_find(headers, device, model)
+            assert index.find_device(device) is common
+            if common is not None :
+                assert index.find_model(common, model) is member
+
+@pytest.mark.parametrize('pattern', ['*.*.W', 'SE10K*.inverter*.A*', 'Export.ac_meter.TotWh*', 'SE*.*.?',
+                                     'SE10K.inverter_single_phase.W', 'S.i.W', 'nothing.*.*', 'SE10K-2.*'])
+def test_wildcards_match_the_linear_scan(headers, pattern) :
+    (device_name, model_pattern, point_name) = (pattern.split('.', maxsplit=2) + ['*', '*'])[:3]
+    expected = []
+    commons = [h for h in headers if h.ID == 1 and
+               (fnmatch.fnmatchcase(h.Md, device_name) or fnmatch.fnmatchcase(h.Opt, device_name))]
+    if not any(c in device_name for c in '*?[') :
+        commons = [c for c in [linear_find(headers, device_name, '')[0]] if c is not None]
+    for c in commons :
+        start = headers.index(c) + 1
+        members = []
+        for h in headers[start:] :
+            if h.ID == 1 :
+                break
+            members.append(h)
+        if any(c in model_pattern for c in '*?[') :
+            members = [m for m in members if fnmatch.fnmatchcase(model_name(m), model_pattern)]
+        else :
+            members = [m for m in members if model_name(m).startswith(model_pattern)][:1]
+        for m in members :
+            expected += [(c, m, p) for p in sEdge.models[m.ID]['group']['point_index'] if fnmatch.fnmatchcase(p, point_name)]
+    assert lookup_index(headers).resolve(pattern) == expected
@@ -0,0 +1,49 @@
+import mbtcp
+
+READS = [(40000 + 2 * i, 2) for i in range(4)]
+
+def expected(registers, reads) :
+    return [[registers[a] for a in range(addr, addr + count)] for (addr, count) in reads]
+
+def test_pipelining_dropped_after_failures_and_probed_again(installation, served, monkeypatch) :
+    (registers, live) = installation
+    (sim, port) = served
+    monkeypatch.setattr(mbtcp, 'REPROBE_BATCHES', 2)
+    client = mbtcp.pipelined_client('127.0.0.1', port, timeout=0.05, window=4)
+    reads = READS
+    assert client.read_many(reads) == expected(registers, reads)
+
+    sim.drop = 1.0
+    for i in range(mbtcp.PIPELINE_FAILURES) :
+        assert client.read_many(reads) == [None] * len(reads)
+    assert (client.window, client.drops, client.reprobe) == (1, 1, 2)
+
+    sim.drop = 0.0
+    for i in range(2) :
+        assert client.window == 1
+        assert client.read_many(reads) == expected(registers, reads)
+    assert client.window == 4
+
+        # failing again after the probe doubles the serial batches before the next one
+    sim.drop = 1.0
+    for i in range(mbtcp.PIPELINE_FAILURES) :
+        client.read_many(reads)
+    assert (client.window, client.drops, client.reprobe) == (1, 2, 4)
+    client.close()
+
+def test_busy_device_is_read_serially_at_once(installation, served, monkeypatch) :
+    (registers, live) = installation
+    (sim, port) = served
+    reply = sim.reply
+    replies = []
+        # the first reply of the connection reports busy
+    def busy(pdu) :
+        replies.append(pdu)
+        return bytes([mbtcp.READ_HOLDING_REGISTERS | 0x80, mbtcp.SERVER_DEVICE_BUSY]) if len(replies) == 1 else reply(pdu)
+    monkeypatch.setattr(sim, 'reply', busy)
+    client = mbtcp.pipelined_client('127.0.0.1', port, timeout=1.0, window=4)
+    reads = READS
+    assert client.read_many(reads) == expected(registers, reads)
+    assert (client.window, client.drops) == (1, 1)
+    assert client.retries == len(reads)
+    client.close()
@@ -0,0 +1,25 @@
+from sEdge import plan_reads, MAX_READ
+
+def test_long_span_is_split_into_full_reads() :
+    assert plan_reads([(40000, 300)]) == [(40000, MAX_READ), (40125, MAX_READ), (40250, 50)]
+
+def test_overlapping_and_adjacent_spans_are_merged() :
+    assert plan_reads([(100, 10), (105, 10), (115, 5)]) == [(100, 20)]
+
+def test_spans_within_gap_are_merged() :
+    assert plan_reads([(100, 4), (110, 2)], gap=16) == [(100, 12)]
+    assert plan_reads([(100, 4), (130, 2)], gap=16) == [(100, 4), (130, 2)]
+
+def test_merge_that_needs_another_request_is_not_made() :
+        # merged, 100..355 would take three reads instead of two
+    assert plan_reads([(100, 120), (230, 125)], gap=16) == [(100, 120), (230, 125)]
+
+def test_refresh_of_all_models_stays_within_the_read_limit(system) :
+    for h in system.headers :
+        system.reference_model(h)
+    client = system.inverter
+    client.requests = 0
+    system.refresh_readings()
+    total = sum(h.length for h in system.headers)
+    assert client.requests == -(-total // MAX_READ)
+    assert all(h.values is not None for h in system.headers)
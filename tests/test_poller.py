@@ -0,0 +1,50 @@
+import math
+
+import pytest
+
+import poller
+from poller import schedule
+
+def test_ticks_stay_on_the_grid() :
+    s = schedule('power', 1.0, [])
+    s.next_due = 100.0
+    s.advance(100.3)                # polled late, but within the interval
+    assert (s.next_due, s.overruns) == (101.0, 0)
+
+def test_overrun_skips_the_missed_ticks() :
+    s = schedule('power', 1.0, [])
+    s.next_due = 100.0
+    s.advance(103.5)                # ticks at 101, 102 and 103 have passed
+    assert (s.next_due, s.overruns) == (104.0, 3)
+    s.advance(105.0)                # finishing the poll of 104 exactly on the next tick skips it
+    assert (s.next_due, s.overruns) == (106.0, 4)
+
+def test_run_once_groups_are_not_due_again() :
+    s = schedule('nameplate', 0, [])
+    s.advance(100.0)
+    assert s.next_due == math.inf
+
+def test_slow_refresh_skips_ticks(system, monkeypatch) :
+    now = [1000.0]
+    monkeypatch.setattr(poller, 'monotonic', lambda: now[0])
+    samples = []
+    p = poller.poller(system, {'power': {'interval': 1, 'points': ['SE10K.inverter.W']},
+                               'energy': {'interval': 10, 'points': ['SE10K.inverter.WH']}},
+                      sink=lambda timestamp, group, values: samples.append(group))
+    refresh = system.refresh_readings
+    def slow(points=None) :
+        refresh(points)
+        now[0] += 2.5
+    monkeypatch.setattr(system, 'refresh_readings', slow)
+    p.start(now[0])
+    p.tick(now[0])
+    (power, energy) = p.schedules
+    assert samples == ['power', 'energy']
+    assert (power.next_due, power.overruns) == (1003.0, 2)
+    assert (energy.next_due, energy.overruns) == (1010.0, 0)
+    p.tick(now[0])
+    assert samples == ['power', 'energy']           # not yet due
+    now[0] = power.next_due
+    p.tick(now[0])
+    assert samples == ['power', 'energy', 'power']
+    assert (power.next_due, power.overruns) == (1006.0, 4)
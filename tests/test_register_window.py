@@ -0,0 +1,35 @@
+import bench
+from sEdge import sEdge, register_window, run_reads
+
+class recording_client(bench.memory_client) :
+    def __init__(self, registers) :
+        super().__init__(registers)
+        self.reads = []
+
+    def read_holding_registers(self, addr, count) :
+        self.reads.append((addr, count))
+        return super().read_holding_registers(addr, count)
+
+def test_large_read_keeps_reading_ahead(installation) :
+    (registers, live) = installation
+    client = recording_client(registers)
+    window = register_window(read_ahead=20)
+    assert run_reads(client, window.read(40000, 30)) == [registers[a] for a in range(40000, 40030)]
+    assert run_reads(client, window.read(40030, 2)) == [registers[40030], registers[40031]]
+    assert run_reads(client, window.read(40032, 2)) == [registers[40032], registers[40033]]
+    assert client.reads == [(40000, 30), (40030, 20)]
+
+def test_read_ahead_past_the_end_reads_only_what_is_needed(installation) :
+    (registers, live) = installation
+    end = max(registers) + 1
+    client = recording_client(registers)
+    window = register_window(read_ahead=20)
+    assert run_reads(client, window.read(end - 4, 2)) == [registers[end - 4], registers[end - 3]]
+    assert run_reads(client, window.read(end - 2, 2)) == [registers[end - 2], registers[end - 1]]
+    assert client.reads == [(end - 4, 20), (end - 4, 2), (end - 2, 2)]
+
+def test_bulk_discovery_finds_the_same_headers(installation) :
+    (registers, live) = installation
+    bulk = sEdge('memory', 0, client=bench.memory_client(registers))
+    serial = sEdge('memory', 0, client=bench.memory_client(registers), bulk_discovery=False)
+    assert [(h.ID, h.offset, h.length) for h in bulk.headers] == [(h.ID, h.offset, h.length) for h in serial.headers]
@@ -0,0 +1,39 @@
+import struct
+from time import monotonic
+
+import pytest
+
+from sEdge import point
+from snapshot import snapshot_writer, snapshot_sEdge
+
+@pytest.fixture
+def published(system) :
+    for h in system.headers :
+        system.reference_model(h)
+    system.refresh_readings()
+    writer = snapshot_writer(system, name=f'modbus_solar_test_{id(system)}')
+    writer.publish()
+    yield writer
+    writer.close()
+
+def test_snapshot_reads_the_published_points(system, published) :
+    w = point(system, 'SE10K', 'inverter', 'W')
+    reader = snapshot_sEdge('memory', 0, name=published.name)
+    try :
+        assert reader.read_points([point(reader, 'SE10K', 'inverter', 'W')]) == [w.read_point()]
+    finally :
+        reader.close()
+
+def test_snapshot_left_in_an_update_times_out(published) :
+    reader = snapshot_sEdge('memory', 0, name=published.name, timeout=0.05)
+    try :
+        w = point(reader, 'SE10K', 'inverter', 'W')
+            # a publisher killed in the middle of a publish leaves the sequence odd
+        struct.pack_into('=Q', published.shm.buf, 0, published.sequence + 1)
+        start = monotonic()
+        with pytest.raises(RuntimeError) :
+            reader.read_points([w])
+        assert monotonic() - start < 1.0
+        assert w.read_point() is None
+    finally :
+        reader.close()
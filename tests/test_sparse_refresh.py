@@ -0,0 +1,38 @@
+import connections
+from sEdge import sEdge, point, plan_reads, read_cost
+
+def test_read_cost_prefers_fewer_requests() :
+    assert read_cost([(0, 125)]) < read_cost([(0, 2), (50, 2)])
+    assert read_cost([(0, 2)]) < read_cost([(0, 10)])
+    assert read_cost([(0, 2), (50, 2)], request_cost=10) < read_cost([(0, 125)], request_cost=10)
+
+def test_sparse_plan_for_few_points(system) :
+    p = point(system, 'SE10K', 'inverter', 'W')
+    reads = system.plan_refresh()
+    assert len(reads) == 1
+    assert reads[0][1] < p.header.length
+
+def test_whole_blocks_when_sparse_needs_more_requests(system) :
+    inverter = point(system, 'SE10K', 'inverter', 'A').header
+    meter = point(system, 'SE10K', 'ac_meter', 'TotWhImp').header
+    point(system, 'SE10K', 'inverter', 'WH')
+    point(system, 'SE10K', 'ac_meter', 'A')
+    whole = plan_reads([(inverter.offset, inverter.length), (meter.offset, meter.length)])
+    sparse = plan_reads([(h.offset + o, size) for h in (inverter, meter) for (o, size) in h.spans])
+    assert len(sparse) > len(whole)
+    assert system.plan_refresh() == whole
+
+def test_sparse_refresh_does_not_decode_unread_registers(served) :
+    (sim, port) = served
+    system = sEdge('127.0.0.1', port, pool=connections.connection_pool(timeout=1.0))
+    w = point(system, 'SE10K', 'inverter', 'W')
+    system.refresh_readings()
+    h = w.header
+    assert w.read_point()[0] is not None
+    assert system.extract_value(h, 'A') is None
+    assert system.extract_value(h, 'ID') == (101, None)
+
+    a = point(system, 'SE10K', 'inverter', 'A')
+    system.refresh_readings()
+    assert a.read_point() == system.extract_value(h, 'A')
+    assert a.read_point()[0] is not None
@@ -0,0 +1,21 @@
+import simulator
+from webserver import state
+
+def reference_all(system) :
+    for h in system.headers :
+        system.reference_model(h)
+
+def test_etags_follow_the_content_across_restarts(installation, system) :
+    (registers, live) = installation
+    reference_all(system)
+    first = state(system)
+    first.update()
+    restarted = state(system)
+    restarted.update()
+    assert first.models
+    assert {i: doc.etag for (i, doc) in first.models.items()} == {i: doc.etag for (i, doc) in restarted.models.items()}
+    assert first.devices.etag == restarted.devices.etag
+
+    simulator.simulator(registers, live).change()
+    restarted.update()
+    assert any(doc.etag != first.models[i].etag for (i, doc) in restarted.models.items())
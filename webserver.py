@@ -0,0 +1,226 @@
+'''
+HTTP server of the current system state
+
+Serves the devices and models of an inverter, and the current values of their points, as
+json. Values come from the shared-memory snapshot published by snapshot.py, so requests
+never cause Modbus traffic. Each model's response is serialized once per change and carries
+an ETag hashed from its content, so tags stay valid across restarts of the server; clients
+sending If-None-Match get 304 Not Modified.
+
+    GET /devices            devices and their models (as sEdge.py --list)
+    GET /models/<n>         point values of the n'th header
+    GET /events             server-sent events, one "model" event per changed model
+
+    python webserver.py [--ip_address <inverter address>] [--listen <port>]
+'''
+import asyncio
+import logging
+import sys
+import json
+import hashlib
+from array import array
+
+from sEdge import sEdge, compile_decoder, raw_decoders, point_spans
+
+log = logging.getLogger(__name__)
+
+    # decodes of a snapshot that was published again meanwhile before an update gives up
+UPDATE_ATTEMPTS = 10
+
+reasons = {200: 'OK', 304: 'Not Modified', 404: 'Not Found', 405: 'Method Not Allowed', 400: 'Bad Request'}
+
+    # pre-serialized json response, tagged with a hash of its body
+class document :
+    def __init__(self, content) :
+        self.body = json.dumps(content, separators=(',', ':'), default=str).encode()
+        self.etag = f'"{hashlib.blake2b(self.body, digest_size=8).hexdigest()}"'
+
+    # current state of a system as pre-serialized documents, rebuilt only for models whose registers changed
+class state :
+    def __init__(self, system) :
+        self.system = system
+        self.registers = {}         # header index -> register values the document was built from
+        self.models = {}            # header index -> document
+        self.listeners = set()      # queues of the event streams
+        self.devices = document(self.device_list())
+
+    def device_list(self) :
+        devices = []
+        for (i, h) in enumerate(self.system.headers) :
+            if h.ID == 1 :
+                devices.append({'Md': h.Md, 'Opt': h.Opt, 'members': []})
+            elif devices :
+                group = sEdge.models[h.ID]['group']
+                devices[-1]['members'].append({'index': i, 'ID': h.ID, 'name': group['name'], 'label': group.get('label')})
+        return devices
+
+        # point values of a model decoded from a copy of its registers and their known flags
+    def model_values(self, h, values, known) :
+        model = sEdge.models[h.ID]
+        points = {}
+        for p in model['group']['points'] :
+            if p['type'] not in raw_decoders and p['type'] != 'string' :
+                continue
+            if known is not None and not all(known[o + i] for (o, size) in point_spans(model, p['name']) for i in range(size)) :
+                continue
+            reading = compile_decoder(model, p['name'])(values)
+            if reading is not None :
+                points[p['name']] = reading
+        return points
+
+        # refresh the system and rebuild the documents of the models that changed. Documents are
+        # decoded from copies of the registers; if the snapshot was published again meanwhile the
+        # copies may be torn, and the update starts over, at most UPDATE_ATTEMPTS times.
+    def update(self) :
+        for attempt in range(UPDATE_ATTEMPTS) :
+            self.system.refresh_readings()
+            rebuilt = {}
+            for (i, h) in enumerate(self.system.headers) :
+                if h.ID == 1 or h.values is None :
+                    continue
+                values = array('H', h.values)
+                known = bytes(h.known) if h.known is not None else None
+                registers = (values.tobytes(), known)
+                if self.registers.get(i) == registers :
+                    continue
+                common = h.common
+                rebuilt[i] = (registers, document({
+                    'index': i, 'ID': h.ID, 'model': sEdge.models[h.ID]['group']['name'],
+                    'device': common.Md if common else None, 'points': self.model_values(h, values, known),
+                }))
+            if getattr(self.system, 'consistent', None) is None or self.system.consistent() :
+                break
+        else :
+            log.error(f"The snapshot changed during each of {UPDATE_ATTEMPTS} updates")
+            raise RuntimeError('No consistent snapshot')
+        for (i, (registers, doc)) in rebuilt.items() :
+            self.registers[i] = registers
+            self.models[i] = doc
+        for queue in self.listeners :
+            for i in rebuilt :
+                queue.put_nowait(self.models[i])
+
+class server :
+    def __init__(self, system, interval=1.0) :
+        self.state = state(system)
+        self.interval = interval
+
+    async def refresh(self) :
+        while True :
+            try :
+                self.state.update()
+            except Exception :
+                log.exception("Unable to update system state")
+            await asyncio.sleep(self.interval)
+
+    async def serve(self, host='', port=8080) :
+        self.state.update()
+        refresher = asyncio.ensure_future(self.refresh())
+        listener = await asyncio.start_server(self.connection, host, port)
+        log.info(f"Serving on port {port}")
+        try :
+            async with listener :
+                await listener.serve_forever()
+        finally :
+            refresher.cancel()
+
+    async def connection(self, reader, writer) :
+        try :
+            while True :
+                request_line = await reader.readline()
+                if not request_line :
+                    break
+                headers = {}
+                while True :
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b'') :
+                        break
+                    (name, _, value) = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                parts = request_line.decode('latin-1').split()
+                if len(parts) != 3 :
+                    self.respond(writer, 400)
+                    break
+                (method, path, version) = parts
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                if method != 'GET' :
+                    self.respond(writer, 405)
+                elif path == '/events' :
+                    await self.events(writer)
+                    break
+                else :
+                    self.get(writer, path.split('?')[0], headers)
+                await writer.drain()
+                if not keep_alive :
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError) :
+            pass
+        finally :
+            writer.close()
+
+    def get(self, writer, path, headers) :
+        doc = None
+        if path == '/devices' :
+            doc = self.state.devices
+        elif path.startswith('/models/') :
+            try :
+                doc = self.state.models.get(int(path[len('/models/'):]))
+            except ValueError :
+                pass
+        if doc is None :
+            self.respond(writer, 404)
+        elif headers.get('if-none-match') == doc.etag :
+            self.respond(writer, 304, etag=doc.etag)
+        else :
+            self.respond(writer, 200, doc.body, doc.etag)
+
+    def respond(self, writer, status, body=b'', etag=None) :
+        head = [f'HTTP/1.1 {status} {reasons[status]}', f'Content-Length: {len(body)}']
+        if body :
+            head.append('Content-Type: application/json')
+        if etag :
+            head.append(f'ETag: {etag}')
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode() + body)
+
+        # stream the current state, then every changed model, as server-sent events
+    async def events(self, writer) :
+        queue = asyncio.Queue()
+        self.state.listeners.add(queue)
+        try :
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n\r\n')
+            for doc in list(self.state.models.values()) :
+                queue.put_nowait(doc)
+            while True :
+                doc = await queue.get()
+                writer.write(b'event: model\r\nid: ' + doc.etag.strip('"').encode() + b'\r\ndata: ' + doc.body + b'\r\n\r\n')
+                await writer.drain()
+        finally :
+            self.state.listeners.discard(queue)
+
+if __name__ == '__main__' :
+    import argparse
+    from snapshot import snapshot_sEdge
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="serve the current system state published by snapshot.py")
+    parser.add_argument("--ip_address", help="IP address of the inverter",
+        default='192.168.12.186')
+    parser.add_argument("--port", help="Modbus/TCP port of the inverter",
+        type=int, default=1502)
+    parser.add_argument("--listen", help="HTTP port to listen on",
+        type=int, default=8080)
+    parser.add_argument("--interval", help="seconds between checks of the snapshot",
+        type=float, default=1.0)
+    args = parser.parse_args()
+
+    try:
+        system = snapshot_sEdge(args.ip_address, args.port)
+    except FileNotFoundError:
+        log.error(f'No snapshot of {args.ip_address}:{args.port} is being published - start snapshot.py')
+        sys.exit(1)
+
+    try:
+        asyncio.run(server(system, args.interval).serve(port=args.listen))
+    except KeyboardInterrupt:
+        pass